@@ -1,2 +1,11 @@
 from .config import Config
-from .whatsapp import WhatsappInstance
+
+# `automate.whatsapp` pulls in the whole browser stack (alright, selenium, webdriver_manager), so
+# it's only imported once one of these is used
+_WHATSAPP = ("WhatsappInstance", "WhatsappPool", "WhatsappWorker")
+
+def __getattr__(name):
+    if name in _WHATSAPP:
+        from . import whatsapp
+        return getattr(whatsapp, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,148 @@
+import random
+import threading
+import time
+from collections import Counter
+
+import gspread
+import requests
+
+# In-memory stand-in for the bits of gspread the automator uses, for benchmarks and dry runs.
+#
+# `FakeClient` plays the role of `gspread.service_account()`: spreadsheets are registered under a
+# URL and opened with `open_by_url`. Every API call sleeps for `latency` seconds, fails with a 429
+# (like the real quota errors) with probability `errors`, and is counted in `calls`. Cells sent
+# through `batch_update` are counted in `cells`, cells fetched in `reads`.
+
+
+class FakeClient:
+    def __init__(self, latency: float = 0.0, errors: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.errors = errors
+        self.random = random.Random(seed)
+
+        self.spreadsheets = {}
+        self.calls = Counter()
+        self.cells = Counter()
+        self.reads = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, url: str, title: str, worksheets: dict):
+        """Register a spreadsheet under `url`, given {worksheet title: rows}."""
+        self.spreadsheets[url] = FakeSpreadsheet(self, title, worksheets)
+        return self.spreadsheets[url]
+
+    def call(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+            fail = self.random.random() < self.errors
+
+        time.sleep(self.latency)
+
+        if fail:
+            response = requests.Response()
+            response.status_code = 429
+            response._content = (b'{"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", '
+                                 b'"message": "Quota exceeded (fake)"}}')
+            raise gspread.exceptions.APIError(response)
+
+    def open_by_url(self, url: str):
+        self.call("open_by_url")
+        if url not in self.spreadsheets:
+            raise gspread.exceptions.SpreadsheetNotFound(url)
+        return self.spreadsheets[url]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"calls": sum(self.calls.values()), "cells": sum(self.cells.values()), "reads": sum(self.reads.values())}
+
+
+class FakeSpreadsheet:
+    def __init__(self, client: FakeClient, title: str, worksheets: dict):
+        self.client = client
+        self.title = title
+        self.modified = 0
+        self._worksheets = {name: FakeWorksheet(self, name, rows) for (name, rows) in worksheets.items()}
+
+    def worksheets(self) -> list:
+        self.client.call("worksheets")
+        return list(self._worksheets.values())
+
+    def worksheet(self, title: str):
+        self.client.call("worksheet")
+        if title not in self._worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._worksheets[title]
+
+    def values_batch_get(self, ranges: list, params: dict = None) -> dict:
+        self.client.call("values_batch_get")
+
+        value_ranges = []
+        for name in ranges:
+            # Whole worksheets, or `'Sheet'!A1:B2`-style ranges of one
+            (title, a1) = name.rsplit("!", 1) if "!" in name else (name, None)
+            ws = self._worksheets[title.strip("'").replace("''", "'")]
+            value_ranges.append({"range": name, "values": ws.values(a1)})
+
+            with self.client.lock:
+                self.client.reads[ws.title] += sum(len(row) for row in value_ranges[-1]["values"])
+
+        return {"spreadsheetId": self.title, "valueRanges": value_ranges}
+
+    def get_lastUpdateTime(self) -> str:
+        self.client.call("get_lastUpdateTime")
+        return str(self.modified)
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet: FakeSpreadsheet, title: str, rows: list):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = [list(row) for row in rows]
+
+    @property
+    def row_count(self) -> int:
+        # Grid size, a bit more than the rows in use like a real sheet
+        return len(self.rows) + 100
+
+    def values(self, a1: str = None) -> list:
+        # Like the API, trailing empty cells and rows are left out
+        values = [list(row) for row in self.rows]
+        if a1 is not None:
+            grid = gspread.utils.a1_range_to_grid_range(a1)
+            values = [row[grid.get("startColumnIndex", 0):grid.get("endColumnIndex")]
+                      for row in values[grid.get("startRowIndex", 0):grid.get("endRowIndex")]]
+
+        for row in values:
+            while len(row) > 0 and row[-1] == "":
+                row.pop()
+        while len(values) > 0 and len(values[-1]) == 0:
+            values.pop()
+        return values
+
+    def get_all_values(self, **kwargs) -> list:
+        self.spreadsheet.client.call("get_all_values")
+        return gspread.utils.fill_gaps(self.values())
+
+    def batch_update(self, data: list, **kwargs):
+        client = self.spreadsheet.client
+        client.call("batch_update")
+
+        for update in data:
+            (row, col) = gspread.utils.a1_to_rowcol(update["range"].split(":")[0])
+
+            for (i, values) in enumerate(update["values"]):
+                while len(self.rows) < row + i:
+                    self.rows.append([])
+
+                target = self.rows[row - 1 + i]
+                while len(target) < col - 1 + len(values):
+                    target.append("")
+
+                for (j, value) in enumerate(values):
+                    target[col - 1 + j] = str(value)
+
+                with client.lock:
+                    client.cells[self.title] += len(values)
+
+        self.spreadsheet.modified += 1
+        return {"totalUpdatedCells": sum(len(row) for update in data for row in update["values"])}
@@ -0,0 +1,205 @@
+from .state import SyncState, changed_rows, key_hashes, row_hashes
+
+import polars as pl
+
+# Cross-sheet identity graph.
+#
+# Several heuristics match the same pair of sheets (scores vs. schedules is used both ways, form vs.
+# schedules and scores by the registry, ...). A `MatchGraph` computes each edge between two models
+# once per sync pass, at the lowest threshold any heuristic needs, and the heuristics then just look
+# their matches up in it.
+#
+# Each edge is also incremental: it starts from the pairs stored by the last pass and only re-matches
+# rows whose identity (name, registration no., phone) changed since. Rows with other edits are just
+# marked for re-evaluation. Rows changed during the pass (through `_ModelGuard.cell`) are folded in
+# the same way on the next lookup.
+
+PAIRS_SCHEMA = {"left": pl.UInt32, "right": pl.UInt32, "score": pl.Float64}
+
+
+def _partners(pairs: pl.DataFrame, col: str, rows, other: str) -> set:
+    if len(rows) == 0:
+        return set()
+    return set(pairs.filter(pl.col(col).is_in(list(rows)))[other].to_list())
+
+
+def clusters(pairs: pl.DataFrame, rows: int) -> pl.Series:
+    # Connected components of a (left, right) pair table over `rows` rows, by union-find. Every row
+    # is labelled with the first row of its component.
+    parent = list(range(rows))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for (a, b) in zip(pairs["left"].to_list(), pairs["right"].to_list()):
+        (a, b) = (find(a), find(b))
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    return pl.Series("cluster", [find(x) for x in range(rows)], dtype=pl.UInt32)
+
+
+class _Edge:
+    def __init__(self, state: SyncState, a, b, threshold: float, rows: list):
+        self.state = state
+        self.a = a
+        self.b = b
+        self.self_match = b is None
+        self.threshold = threshold
+        self.rows = None if rows is None else set(rows)
+
+        self.name = a.name if self.self_match else f"{a.name}-{b.name}"
+        self.models = [a] if self.self_match else [a, b]
+        self.hashes = {model.name: row_hashes(model) for model in self.models}
+
+        # Only rows touched after this point are folded in by `refresh`
+        self.seen = {model.name: (set(model.touched), set(model.rekeyed)) for model in self.models}
+
+        stored = state.load(self.name, self.models, threshold=threshold)
+        changed = None
+
+        if stored is not None:
+            (hashes, keys, pairs) = stored
+            changed = [changed_rows(self.hashes[model.name], hashes[model.name]) for model in self.models]
+            rekeyed = [changed_rows(key_hashes(model), keys[model.name]) for model in self.models]
+            if None in changed or None in rekeyed:
+                changed = None
+
+        if changed is None:
+            # Full pass
+            self.pairs = a.matches(b, threshold=threshold, rows=None if rows is None else sorted(rows))
+            self.dirty_a = set(range(a.records.height)) if rows is None else set(rows)
+            self.dirty_b = self.dirty_a if self.self_match else set(range(b.records.height))
+        else:
+            self.pairs = pairs
+            self.dirty_a = set()
+            self.dirty_b = self.dirty_a if self.self_match else set()
+            self._apply(rekeyed[0], rekeyed[-1], rekey=True)
+            self._apply(changed[0], changed[-1], rekey=False)
+
+    def _apply(self, changed_a, changed_b, rekey: bool):
+        # Mark rows as changed: they and everything matched to them need re-evaluating. If `rekey`,
+        # their identity may have changed too, so their pairs are recomputed.
+        changed_a = set(changed_a)
+        if self.rows is not None:
+            changed_a &= self.rows
+        changed_b = changed_a if self.self_match else set(changed_b)
+
+        old = self.pairs
+
+        if rekey and (len(changed_a) > 0 or len(changed_b) > 0):
+            keep = self.pairs.filter(~pl.col("left").is_in(list(changed_a)) & ~pl.col("right").is_in(list(changed_b)))
+            if self.self_match:
+                keep = keep.filter(~pl.col("left").is_in(list(changed_b)) & ~pl.col("right").is_in(list(changed_a)))
+
+            # Only the changed rows are compared again, against the whole of the other side
+            fresh = self.a.fold(self.b, threshold=self.threshold, rows=sorted(changed_a),
+                                other_rows=() if self.self_match else sorted(changed_b), within=self.rows)
+            self.pairs = pl.concat([keep, fresh]).unique(["left", "right"]).sort("left", "right")
+
+        for pairs in (old, self.pairs):
+            if self.self_match:
+                self.dirty_a |= _partners(pairs, "left", changed_a, "right")
+                self.dirty_a |= _partners(pairs, "right", changed_a, "left")
+            else:
+                self.dirty_a |= _partners(pairs, "right", changed_b, "left")
+                self.dirty_b |= _partners(pairs, "left", changed_a, "right")
+
+        self.dirty_a |= changed_a
+        self.dirty_b |= changed_b
+
+    def refresh(self):
+        touched = []
+        rekeyed = []
+
+        for model in self.models:
+            (seen_touched, seen_rekeyed) = self.seen[model.name]
+            touched.append(model.touched - seen_touched)
+            rekeyed.append(model.rekeyed - seen_rekeyed)
+            self.seen[model.name] = (set(model.touched), set(model.rekeyed))
+
+        if any(len(r) > 0 for r in rekeyed):
+            self._apply(rekeyed[0], rekeyed[-1], rekey=True)
+        if any(len(t) > 0 for t in touched):
+            self._apply(touched[0], touched[-1], rekey=False)
+
+    def lookup(self, threshold: float, reverse: bool = False):
+        # (rows to re-evaluate, their matches above `threshold`) from either side of the edge
+        self.refresh()
+
+        if threshold < self.threshold:
+            raise ValueError(f"edge {self.name} was built at {self.threshold}, can't look up {threshold}")
+
+        pairs = self.pairs.filter(pl.col("score") > threshold)
+        dirty = self.dirty_a
+
+        if reverse:
+            pairs = pairs.select(pl.col("right").alias("left"), pl.col("left").alias("right"), "score")
+            dirty = self.dirty_b
+
+        return (sorted(dirty), pairs.filter(pl.col("left").is_in(list(dirty))).sort("left", "right"))
+
+    def all(self, threshold: float, reverse: bool = False) -> pl.DataFrame:
+        # Every match above `threshold`, whether its rows need re-evaluating or not
+        self.refresh()
+
+        if threshold < self.threshold:
+            raise ValueError(f"edge {self.name} was built at {self.threshold}, can't look up {threshold}")
+
+        pairs = self.pairs.filter(pl.col("score") > threshold)
+        if reverse:
+            pairs = pairs.select(pl.col("right").alias("left"), pl.col("left").alias("right"), "score")
+        return pairs.sort("left", "right")
+
+    def save(self):
+        # Identities are saved as they are by now, every change to them during the pass being folded
+        # into the pairs first. Rows written during the pass are then re-evaluated next time (their
+        # row hash is still the one from the start), but not matched again.
+        self.refresh()
+        keys = {model.name: key_hashes(model) for model in self.models}
+        self.state.save(self.name, self.models, self.hashes, keys, self.pairs.cast(PAIRS_SCHEMA),
+                        threshold=self.threshold)
+
+
+class MatchGraph:
+    def __init__(self, state: SyncState):
+        self.state = state
+        self.edges = {}
+
+    def add(self, left, right=None, threshold: float = 0.0, rows: list = None):
+        """Build the edge between `left` and `right` (or `left` and itself).
+
+        `rows` restricts the left side to those rows. Lookups can use any threshold at or above
+        the one given here.
+        """
+        key = (left.name, None if right is None else right.name)
+        if key not in self.edges:
+            self.edges[key] = _Edge(self.state, left, right, threshold, rows)
+        return self.edges[key]
+
+    def lookup(self, left, right=None, threshold: float = 0.0, rows: list = None):
+        """Rows of `left` to re-evaluate and their matches in `right` (or `left`) above `threshold`.
+
+        Returns (rows, matches), matches being a (left, right, score) table. The edge is added
+        first if the graph doesn't have it yet, in either direction.
+        """
+        if right is not None and (right.name, left.name) in self.edges:
+            return self.edges[(right.name, left.name)].lookup(threshold, reverse=True)
+        return self.add(left, right, threshold, rows).lookup(threshold)
+
+    def pairs(self, left, right=None, threshold: float = 0.0) -> pl.DataFrame:
+        """Every match of `left` in `right` (or `left`) above `threshold`, as a (left, right, score) table.
+
+        Unlike `lookup`, rows that don't need re-evaluating are included, for heuristics that need
+        the whole neighbourhood of the rows they look at.
+        """
+        if right is not None and (right.name, left.name) in self.edges:
+            return self.edges[(right.name, left.name)].all(threshold, reverse=True)
+        return self.add(left, right, threshold).all(threshold)
+
+    def save(self):
+        for edge in self.edges.values():
+            edge.save()
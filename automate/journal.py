@@ -0,0 +1,111 @@
+from . import log
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# Append-only journal of scheduling messages.
+#
+# Every message of a scheduling run goes through it as JSON lines:
+# - `planned`: the candidate was given a slot in a block
+# - `sent`: WhatsApp delivered the message, with the cells that record it in the sheet
+# - `confirmed`: those cells made it to the sheet
+# - `failed`: the candidate couldn't be reached
+#
+# Entries are keyed by (candidate, block), a block being identified by its start time. A candidate
+# already `sent` for a block is never messaged again for it, and a `sent` entry without a matching
+# `confirmed` is a sheet write that may have been lost, which `Automator.replay_journal` re-applies.
+#
+# Every line is flushed to the OS as it's written, which survives the process dying. fsync (for
+# power loss) is batched: once `sync_every` lines or `sync_delay` seconds have gone by, and on close.
+
+
+class SendJournal:
+    sync_every = 32
+    sync_delay = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+
+        # (candidate, block) -> last `sent` entry, and the subset not `confirmed` yet
+        self.sent = {}
+        self.unconfirmed = {}
+        self._load()
+
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+
+        for (i, line) in enumerate(lines):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn last line from a crash mid-write is expected, anything else isn't
+                if i != len(lines) - 1:
+                    log.warn(f"Skipping unreadable line {i + 1} of {self.path}")
+                continue
+
+            self._apply(entry)
+
+    def _apply(self, entry: dict):
+        key = (entry["candidate"], entry["block"])
+
+        if entry["event"] == "sent":
+            self.sent[key] = entry
+            self.unconfirmed[key] = entry
+        elif entry["event"] == "confirmed":
+            self.unconfirmed.pop(key, None)
+
+    def record(self, event: str, candidate: str, block: str, **fields):
+        entry = {"event": event, "candidate": candidate, "block": block, "at": datetime.now().isoformat(), **fields}
+
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+
+                # Start on a fresh line, whatever a crash left at the end of the file
+                if self.file.tell() > 0:
+                    self.file.write("\n")
+
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            self._apply(entry)
+
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_delay:
+                self._sync()
+
+    def is_sent(self, candidate: str, block: str) -> bool:
+        return (candidate, block) in self.sent
+
+    def pending(self) -> list:
+        # `sent` entries whose sheet write wasn't confirmed
+        return list(self.unconfirmed.values())
+
+    def _sync(self):
+        if self.file is not None and self.unsynced > 0:
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -1,25 +1,41 @@
+from . import metrics
+
 import time
 from datetime import datetime
 
 from colorama import Fore, Style
 
-def trace(message):
+# Every function takes optional structured fields, printed after the message and recorded with it
+# in the metrics event log.
+
+def _fields(fields: dict) -> str:
+    if len(fields) == 0:
+        return ""
+    return "  " + " ".join(f"{key}={value}" for (key, value) in fields.items())
+
+def trace(message, **fields):
     print('', end='\x1b[1K\r')
     print(f"{Fore.LIGHTBLACK_EX}", end='')
     print(f" [INFO][{datetime.now().strftime('%H:%M:%S')}] ", end='')
     print(message, end='')
+    print(_fields(fields), end='')
     print(f"{Style.RESET_ALL}")
+    metrics.event("log", "trace", message=str(message), **fields)
 
-def info(message):
+def info(message, **fields):
     print('', end='\x1b[1K\r')
     print(f"{Fore.LIGHTBLACK_EX}", end='')
     print(f" [INFO][{datetime.now().strftime('%H:%M:%S')}] ", end='')
     print(f"{Style.RESET_ALL}", end='')
-    print(message)
+    print(message, end='')
+    print(f"{Fore.LIGHTBLACK_EX}{_fields(fields)}{Style.RESET_ALL}")
+    metrics.event("log", "info", message=str(message), **fields)
 
-def warn(message):
+def warn(message, **fields):
     print('', end='\x1b[1K\r')
     print(f"{Fore.LIGHTMAGENTA_EX}", end='')
     print(f" [INFO][{datetime.now().strftime('%H:%M:%S')}] ", end='')
     print(f"{Style.RESET_ALL}", end='')
-    print(message)
+    print(message, end='')
+    print(f"{Fore.LIGHTBLACK_EX}{_fields(fields)}{Style.RESET_ALL}")
+    metrics.event("log", "warn", message=str(message), **fields)
@@ -0,0 +1,219 @@
+from . import metrics
+
+import atexit
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
+
+import phonenumbers
+import polars as pl
+
+# Candidate generation for the fuzzy matching heuristics.
+#
+# `Automator.duplicate_score` is expensive (two `SequenceMatcher` ratios), so instead of scoring
+# every row against every other row, every pair is first given an upper bound of its score, all at
+# once in polars, and only the pairs whose bound clears the threshold are scored.
+#
+# The bound is `SequenceMatcher.quick_ratio` of the names and of the registration numbers: the
+# characters two strings have in common (counted with repeats) are at least as many as those
+# `SequenceMatcher` matches, so 2 * common / (len(a) + len(b)) is never below the ratio. It's worked
+# out from per-row character counts, the registration numbers first (a pair with a name ratio of 1
+# still has to clear the threshold on those) and the names only for the pairs left. A pair is left
+# out only when it can't possibly score above the threshold, so the matches are exactly those of
+# scoring every pair, just without scoring them all.
+#
+# Both thresholds used by the heuristics (0.82 * 6 and 0.90 * 6) need a registration ratio of at
+# least ~0.64 on top of a close name, or matching phones, which only a small part of the pairs of a
+# sheet come anywhere near.
+
+def e164(phone, region: str = "IN") -> str:
+    # Unparseable numbers are kept as typed, so they still only compare equal to themselves
+    phone = "" if phone is None else str(phone).strip()
+    try:
+        return phonenumbers.format_number(phonenumbers.parse(phone, region), phonenumbers.PhoneNumberFormat.E164)
+    except phonenumbers.NumberParseException:
+        return phone
+
+
+# -----------------------------------------------------------------------------
+#                           BATCH MATCHING
+# -----------------------------------------------------------------------------
+
+# Pairs scored per worker task. Anything smaller than one chunk is scored in-process, since handing
+# it to the pool costs more than it saves.
+CHUNK_SIZE = 20000
+
+# Started on the first batch big enough to need it, and kept for every later one (the incremental
+# lookups run many small batches in a pass), see `_executor`
+_pool = None
+_pool_lock = threading.Lock()
+
+def _executor() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def duplicate_score(A_name: str, A_reg: str, A_ph, B_name: str, B_reg: str, B_ph) -> float:
+    return (SequenceMatcher(None, A_name, B_name).ratio() * 2) + \
+           (SequenceMatcher(None, A_reg, B_reg).ratio() * 3) +   \
+           (A_ph == B_ph)
+
+def _ratio(a: str, b: str) -> float:
+    # `SequenceMatcher` gives exactly 1.0 for equal strings, skip the work
+    return 1.0 if a == b else SequenceMatcher(None, a, b).ratio()
+
+def _score_chunk(chunk) -> list:
+    a_names, b_names, a_regs, b_regs, phone_eq = chunk
+    return [
+        (_ratio(an, bn) * 2) + (_ratio(ar, br) * 3) + eq
+        for (an, bn, ar, br, eq) in zip(a_names, b_names, a_regs, b_regs, phone_eq)
+    ]
+
+# Pairs bounded at once by `match_table`, bigger sweeps go a slice of the left side at a time
+SWEEP_SIZE = 1_000_000
+
+def _chars(*columns) -> list:
+    # Every character used in some string of the given columns
+    return sorted(set("".join(pl.concat(columns).drop_nulls().unique().to_list())))
+
+def _counts(col: str, chars: list, prefix: str) -> list:
+    # How many times each of `chars` is in `col`, as `<prefix>0`, `<prefix>1`... A cell holds at
+    # most 50000 characters, which fits.
+    return [pl.col(col).str.count_matches(c, literal=True).cast(pl.UInt16).alias(f"{prefix}{i}") for (i, c) in enumerate(chars)]
+
+def _quick_ratio(prefix: str, count: int, length: pl.Expr) -> pl.Expr:
+    # `SequenceMatcher.quick_ratio` of a pair out of its `_counts` columns, worked out like `ratio`
+    # (2.0 * matches / length) so it can't be rounded below it either
+    common = pl.sum_horizontal(pl.min_horizontal(f"{prefix}{i}", f"{prefix}{i}_right") for i in range(count)) \
+             if count > 0 else pl.lit(0)
+    return pl.when(length == 0).then(1.0).otherwise(2.0 * common / length)
+
+
+def match_table(left: pl.DataFrame, left_cols: tuple, right: pl.DataFrame = None, right_cols: tuple = None,
+                threshold: float = 0.0, workers: int = None, left_rows: list = None, right_rows: list = None) -> pl.DataFrame:
+    """Score every pair between two frames, or a frame and itself, that could score above `threshold`.
+
+    `left_cols`/`right_cols` are the (name, registration, phone) column names of each frame, which
+    should already be normalized (see `PolarsModel.keys`). A `None`
+    phone column on either side scores the phones as `None == None`, exactly like the heuristics
+    calling `duplicate_score` with no phones.
+
+    `left_rows`/`right_rows` restrict either side to some of its rows. Against itself, `left_rows`
+    means every pair involving one of them.
+
+    Returns a sparse table of (left, right, score) for pairs scoring above `threshold`, ordered by
+    left then right, the same as scoring every pair would. For a self-match only pairs with
+    left < right are reported.
+    """
+    self_match = right is None
+    if self_match:
+        (right, right_cols, right_rows) = (left, left_cols, None)
+    use_phone = left_cols[2] is not None and right_cols[2] is not None
+
+    def only(frame, cols, rows):
+        frame = frame.select(pl.col(cols[0]).alias("name"), pl.col(cols[1]).alias("reg"),
+                             (pl.col(cols[2]) if use_phone else pl.lit(None, dtype=pl.String)).alias("phone")) \
+                     .with_row_index("row")
+        return frame if rows is None else frame.filter(pl.col("row").is_in(rows))
+
+    a = only(left, left_cols, left_rows)
+    b = only(right, right_cols, right_rows)
+
+    names = _chars(a["name"], b["name"])
+    regs = _chars(a["reg"], b["reg"])
+
+    def profile(frame):
+        return (frame.select("row", "phone", pl.col("reg").str.len_chars().alias("reg_len"), *_counts("reg", regs, "r")),
+                frame.select("row", pl.col("name").str.len_chars().alias("name_len"), *_counts("name", names, "n")))
+
+    (a_regs, a_names) = profile(a)
+    (b_regs, b_names) = profile(b)
+
+    reg = _quick_ratio("r", len(regs), pl.col("reg_len") + pl.col("reg_len_right"))
+    name = _quick_ratio("n", len(names), pl.col("name_len") + pl.col("name_len_right"))
+    phone = (pl.col("phone") == pl.col("phone_right")).fill_null(False) if use_phone else pl.lit(True)
+
+    # Registration numbers first, assuming the names are equal, then the names of the pairs left.
+    # Same sums as `_score_chunk`, with ratios that are never lower.
+    found = []
+    step = max(1, SWEEP_SIZE // max(b.height, 1))
+
+    with metrics.span("bound_pairs", rows=a.height, other=b.height):
+        for start in range(0, a.height, step):
+            chunk = a_regs.slice(start, step)
+
+            if self_match and left_rows is None:
+                pairs = chunk.join(b_regs.filter(pl.col("row") > chunk["row"].min()), how="cross") \
+                             .filter(pl.col("row") < pl.col("row_right"))
+            elif self_match:
+                pairs = chunk.join(b_regs, how="cross").filter(pl.col("row") != pl.col("row_right"))
+            else:
+                pairs = chunk.join(b_regs, how="cross")
+
+            found.append(pairs.select("row", "row_right", reg.alias("reg"), phone.cast(pl.Float64).alias("phone"))
+                              .filter(((1.0 * 2) + (pl.col("reg") * 3)) + pl.col("phone") > threshold))
+
+        pairs = pl.concat(found) if len(found) > 0 else \
+                pl.DataFrame(schema={"row": pl.UInt32, "row_right": pl.UInt32, "reg": pl.Float64, "phone": pl.Float64})
+        pairs = pairs.join(a_names, on="row") \
+                     .join(b_names, left_on="row_right", right_on="row", suffix="_right") \
+                     .filter(((name * 2) + (pl.col("reg") * 3)) + pl.col("phone") > threshold)
+
+    if self_match:
+        pairs = pairs.select(pl.min_horizontal("row", "row_right").alias("left"), pl.max_horizontal("row", "row_right").alias("right"))
+    else:
+        pairs = pairs.select(pl.col("row").alias("left"), pl.col("row_right").alias("right"))
+    pairs = pairs.unique().sort("left", "right")
+
+    return score_pairs(pairs, left, left_cols, right, right_cols, threshold=threshold, workers=workers)
+
+
+def score_pairs(pairs: pl.DataFrame, left: pl.DataFrame, left_cols: tuple, right: pl.DataFrame, right_cols: tuple,
+                threshold: float = 0.0, workers: int = None) -> pl.DataFrame:
+    # `duplicate_score` of (left, right) row pairs of two frames, the candidates of `match_table`.
+    # Returns the pairs scoring above `threshold`, in the same order.
+    empty = pl.DataFrame(schema={"left": pl.UInt32, "right": pl.UInt32, "score": pl.Float64})
+    if pairs.height == 0:
+        return empty
+
+    use_phone = left_cols[2] is not None and right_cols[2] is not None
+    (l, r) = (pairs["left"], pairs["right"])
+
+    # Gather both sides of every pair into flat arrays
+    columns = [
+        left.get_column(left_cols[0]).gather(l).to_list(),
+        right.get_column(right_cols[0]).gather(r).to_list(),
+        left.get_column(left_cols[1]).gather(l).to_list(),
+        right.get_column(right_cols[1]).gather(r).to_list(),
+    ]
+    if use_phone:
+        columns.append((left.get_column(left_cols[2]).gather(l) ==
+                        right.get_column(right_cols[2]).gather(r)).fill_null(False).to_list())
+    else:
+        columns.append([True] * pairs.height)
+
+    chunks = [
+        tuple(c[i:i + CHUNK_SIZE] for c in columns)
+        for i in range(0, pairs.height, CHUNK_SIZE)
+    ]
+
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    with metrics.span("score_pairs", pairs=pairs.height, workers=workers):
+        if workers == 1:
+            scores = [x for chunk in chunks for x in _score_chunk(chunk)]
+        else:
+            scores = [x for chunk in _executor().map(_score_chunk, chunks) for x in chunk]
+
+    matches = pairs.select(pl.col("left").cast(pl.UInt32), pl.col("right").cast(pl.UInt32)) \
+                   .with_columns(pl.Series("score", scores, dtype=pl.Float64)) \
+                   .filter(pl.col("score") > threshold)
+
+    metrics.count("pairs_compared", pairs.height)
+    metrics.count("matches", matches.height)
+    return matches
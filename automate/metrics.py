@@ -0,0 +1,142 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+# Timing spans and counters.
+#
+# `span` times a block of code, `count` adds to a counter and `gauge` sets a value, all with
+# arbitrary fields as labels. Every span and log line (see `automate.log`) is appended to
+# `./.data/metrics/events.jsonl` as it happens, and `export` writes the running totals to
+# `./.data/metrics/automate.prom` in the Prometheus textfile format (point node_exporter's textfile
+# collector at the directory).
+#
+# The event log is rotated to `events.jsonl.1` once it reaches `MAX_BYTES`, so a process left
+# running for days (see `--watch`) keeps at most twice that on disk.
+
+PATH = "./.data/metrics"
+MAX_BYTES = 64 * 1024 * 1024
+
+_lock = threading.Lock()
+_events = None
+_size = 0
+
+# (name, sorted labels) -> [count, total seconds] / total
+_spans = defaultdict(lambda: [0, 0.0])
+_counters = defaultdict(float)
+_gauges = {}
+
+
+def _labels(fields: dict) -> tuple:
+    # Short strings make sensible labels. Numbers (row counts, sizes...) only go to the event log.
+    return tuple(sorted((k, str(v)) for (k, v) in fields.items() if isinstance(v, (str, bool)) and len(str(v)) <= 64))
+
+
+def event(kind: str, name: str, **fields):
+    global _events, _size
+
+    line = json.dumps({"at": datetime.now().isoformat(), "type": kind, "name": name, **fields}, default=str)
+    target = os.path.join(PATH, "events.jsonl")
+
+    with _lock:
+        if _events is not None and _size >= MAX_BYTES:
+            _events.close()
+            _events = None
+            os.replace(target, target + ".1")
+
+        if _events is None:
+            os.makedirs(PATH, exist_ok=True)
+            _events = open(target, 'a', encoding='utf-8')
+            _size = _events.tell()
+
+        _events.write(line + "\n")
+        _size += len(line) + 1
+
+
+@contextmanager
+def span(name: str, **fields):
+    """Time the block as `name`. Fields can be added to `fields` from inside it."""
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield fields
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+
+        with _lock:
+            totals = _spans[(name, _labels(fields))]
+            totals[0] += 1
+            totals[1] += seconds
+
+        event("span", name, seconds=round(seconds, 6), failed=failed, **fields)
+
+
+def count(name: str, amount: float = 1, **labels):
+    with _lock:
+        _counters[(name, _labels(labels))] += amount
+
+
+def gauge(name: str, value: float, **labels):
+    with _lock:
+        _gauges[(name, _labels(labels))] = value
+
+
+def _format(name: str, labels: tuple, value) -> str:
+    def escape(v):
+        return v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    if len(labels) == 0:
+        return f"{name} {value}"
+
+    pairs = ",".join(k + '="' + escape(v) + '"' for (k, v) in labels)
+    return f"{name}{{{pairs}}} {value}"
+
+
+def export():
+    with _lock:
+        if _events is not None:
+            _events.flush()
+
+        lines = [
+            "# HELP automate_span_seconds Time spent in each instrumented stage",
+            "# TYPE automate_span_seconds summary",
+        ]
+        for ((name, labels), (n, seconds)) in sorted(_spans.items()):
+            labels = (("span", name),) + labels
+            lines.append(_format("automate_span_seconds_sum", labels, seconds))
+            lines.append(_format("automate_span_seconds_count", labels, n))
+
+        names = sorted({name for (name, _) in _counters})
+        for name in names:
+            lines.append(f"# TYPE automate_{name}_total counter")
+            for ((n, labels), value) in sorted(_counters.items()):
+                if n == name:
+                    lines.append(_format(f"automate_{name}_total", labels, value))
+
+        names = sorted({name for (name, _) in _gauges})
+        for name in names:
+            lines.append(f"# TYPE automate_{name} gauge")
+            for ((n, labels), value) in sorted(_gauges.items()):
+                if n == name:
+                    lines.append(_format(f"automate_{name}", labels, value))
+
+        if len(lines) == 2:
+            return
+
+        # Written aside and moved in place, so a scrape never sees half a file. Still under the lock,
+        # as concurrent syncs (see `Automator.sync_subsystems`) would otherwise share the tmp file.
+        os.makedirs(PATH, exist_ok=True)
+        target = os.path.join(PATH, "automate.prom")
+        with open(target + ".tmp", 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(target + ".tmp", target)
+
+
+atexit.register(export)
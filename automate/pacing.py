@@ -0,0 +1,63 @@
+import random
+import threading
+import time
+
+# Send pacing for WhatsApp Web.
+#
+# A `Pacer` spaces out the sends of one sender with AIMD: every send that went through quickly lets
+# the rate creep up by `increase` sends per minute, and every failed or slow send (WhatsApp Web
+# taking longer than `latency` to deliver) halves it. The pause between sends always stays within
+# [min, max] seconds.
+
+
+class Pacer:
+    def __init__(self, start: float, min_delay: float, max_delay: float, latency: float,
+                 increase: float = 1.0, decrease: float = 0.5):
+        # Rates are in sends per minute
+        self.min_rate = 60 / max_delay
+        self.max_rate = 60 / min_delay
+        self.rate = min(max(60 / start, self.min_rate), self.max_rate)
+
+        self.latency = latency
+        self.increase = increase
+        self.decrease = decrease
+
+        self.last = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        records = config.records["whatsapp"]
+        pace = records.get("pace", {})
+        start = float(records["sleep"])
+
+        return cls(start,
+                   float(pace.get("min", start)),
+                   float(pace.get("max", start)),
+                   float(pace.get("latency", records["timeout"])),
+                   float(pace.get("increase", 1.0)))
+
+    @property
+    def delay(self) -> float:
+        return 60 / self.rate
+
+    # Block until the next send is due
+    def wait(self):
+        with self.lock:
+            due = self.last + self.delay if self.last is not None else 0
+        time.sleep(max(0.0, due - time.monotonic()))
+
+    def record(self, seconds: float, ok: bool):
+        with self.lock:
+            self.last = time.monotonic()
+
+            if ok and seconds <= self.latency:
+                self.rate = min(self.rate + self.increase, self.max_rate)
+            else:
+                self.rate = max(self.rate * self.decrease, self.min_rate)
+
+
+# Seconds to wait before retry number `attempt` (from 1): exponential, with full jitter so retries
+# from several senders don't line up
+def backoff(attempt: int, base: float, cap: float) -> float:
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
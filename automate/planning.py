@@ -0,0 +1,48 @@
+import math
+from datetime import datetime, timedelta
+
+import polars as pl
+
+# Interview slot planning.
+#
+# A scheduling block is `capacity`: one (slot, room) pair per interview that fits, `slot` counting
+# interview durations from the start of the block and `room` the parallel interviews within one.
+# `plan` pairs eligible candidates with free capacity, in sheet order, in one pass. Whatever doesn't
+# fit is kept in the plan without a slot.
+
+CANDIDATE_COLS = ["row", "Full Name", "WhatsApp Number"]
+
+
+def capacity(start: datetime, block: timedelta, duration: timedelta, at_once: int) -> pl.DataFrame:
+    slots = math.ceil(block / duration)
+    return pl.DataFrame({"slot": range(slots)}, schema={"slot": pl.UInt32}) \
+             .join(pl.DataFrame({"room": range(1, at_once + 1)}, schema={"room": pl.UInt32}), how="cross") \
+             .with_columns((pl.lit(start) + pl.lit(duration) * pl.col("slot")).alias("time")) \
+             .sort("slot", "room")
+
+
+def eligible(schedules) -> pl.DataFrame:
+    # Rows of the schedule sheet that haven't been given a time, and haven't already been interviewed
+    return pl.concat([
+        schedules.records.select("Full Name").with_row_index("row"),
+        schedules.norm.select("WhatsApp Number", "Interview Date/Time", "Appeared"),
+    ], how="horizontal").filter(
+        (pl.col("Interview Date/Time") == "") & (pl.col("Appeared") != "yes")
+    ).select(CANDIDATE_COLS)
+
+
+def plan(candidates: pl.DataFrame, free: pl.DataFrame) -> pl.DataFrame:
+    """Give each candidate, in order, the next free (slot, room).
+
+    Returns the candidates with their `slot`, `room` and `time`, which are null for candidates
+    past the end of `free`.
+    """
+    return candidates.select(CANDIDATE_COLS) \
+                     .with_row_index("order") \
+                     .join(free.select("slot", "room", "time").with_row_index("order"), on="order", how="left") \
+                     .drop("order")
+
+
+def leftover(free: pl.DataFrame, taken: pl.DataFrame) -> pl.DataFrame:
+    # Capacity in `free` that none of `taken` occupies
+    return free.join(taken.select("slot", "room"), on=["slot", "room"], how="anti").sort("slot", "room")
@@ -0,0 +1,171 @@
+from . import log
+from . import metrics
+from .pacing import backoff
+
+import json
+import threading
+import time
+from collections import defaultdict
+
+import gspread
+import requests
+
+# Quota-aware access to the Sheets API.
+#
+# `SheetsClient` wraps a gspread client (or anything shaped like one, see `automate.fake`), and the
+# spreadsheets and worksheets it hands out. Every call through them:
+# - waits for the per-minute read or write quota, with a client-side token bucket per kind
+# - is retried on 429s, 5xxs and dropped connections, with jittered exponential backoff
+# - is counted (calls, cells, bytes) against its worksheet, see `SheetsClient.stats`
+#
+# Google's defaults are 60 reads and 60 writes per minute per user, which is what the limits start
+# at (see `sheets_api` in settings.yaml).
+
+TRANSIENT = (429, 500, 502, 503, 504)
+
+
+class _Bucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            # Going negative reserves the token, so concurrent callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        time.sleep(wait)
+
+
+class SheetsClient:
+    def __init__(self, client, reads_per_minute: float = 60, writes_per_minute: float = 60,
+                 tries: int = 6, base: float = 1.0, cap: float = 64.0):
+        self.client = client
+        self.buckets = {"read": _Bucket(reads_per_minute), "write": _Bucket(writes_per_minute)}
+        self.tries = tries
+        self.base = base
+        self.cap = cap
+
+        # (spreadsheet title, worksheet title) -> {"calls", "cells", "bytes", "retries"}
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, client, config):
+        limits = config.records.get("sheets_api", {})
+        return cls(client,
+                   float(limits.get("reads_per_minute", 60)),
+                   float(limits.get("writes_per_minute", 60)),
+                   int(limits.get("tries", 6)),
+                   float(limits.get("backoff", 1.0)))
+
+    def call(self, kind: str, keys: list, function, *args, **kwargs):
+        for attempt in range(1, self.tries + 1):
+            self.buckets[kind].take()
+            self.count(keys, calls=1)
+
+            try:
+                return function(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                if e.code not in TRANSIENT or attempt == self.tries:
+                    raise
+                reason = f"{e.code}"
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.tries:
+                    raise
+                reason = type(e).__name__
+
+            wait = backoff(attempt, self.base, self.cap)
+            self.count(keys, retries=1)
+            metrics.count("sheets_api_retries", kind=kind, reason=reason)
+            log.trace(f"Sheets API {kind} failed ({reason}), retrying in {wait:.1f}s", attempt=attempt)
+            time.sleep(wait)
+
+    def count(self, keys: list, **amounts):
+        with self.lock:
+            for key in keys:
+                for (name, amount) in amounts.items():
+                    self.counters[key][name] += amount
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {key: dict(counter) for (key, counter) in self.counters.items()}
+
+    def open_by_url(self, url: str):
+        return QuotaSpreadsheet(self, self.call("read", [], self.client.open_by_url, url))
+
+
+def _sheet_of(a1: str) -> str:
+    # Worksheet title of an A1 range like `'Sheet 1'!A1:B2`
+    name = a1.rsplit("!", 1)[0] if "!" in a1 else a1
+    if name.startswith("'") and name.endswith("'"):
+        name = name[1:-1].replace("''", "'")
+    return name
+
+def _size(values: list) -> tuple:
+    # (cells, bytes) of a 2D list of values
+    return (sum(len(row) for row in values), len(json.dumps(values)))
+
+
+class QuotaSpreadsheet:
+    def __init__(self, client: SheetsClient, spreadsheet):
+        self.client = client
+        self.spreadsheet = spreadsheet
+        self.title = spreadsheet.title
+
+    def __getattr__(self, name):
+        return getattr(self.spreadsheet, name)
+
+    def worksheets(self) -> list:
+        worksheets = self.client.call("read", [], self.spreadsheet.worksheets)
+        return [QuotaWorksheet(self.client, self, ws) for ws in worksheets]
+
+    def worksheet(self, title: str):
+        return QuotaWorksheet(self.client, self, self.client.call("read", [], self.spreadsheet.worksheet, title))
+
+    def values_batch_get(self, ranges: list, *args, **kwargs) -> dict:
+        keys = [(self.title, _sheet_of(r)) for r in ranges]
+        response = self.client.call("read", keys, self.spreadsheet.values_batch_get, ranges, *args, **kwargs)
+
+        for (key, value_range) in zip(keys, response.get("valueRanges", [])):
+            (cells, size) = _size(value_range.get("values", []))
+            self.client.count([key], cells=cells, bytes=size)
+        return response
+
+    def get_lastUpdateTime(self) -> str:
+        # A Drive API call, with its own (much larger) quota
+        return self.spreadsheet.get_lastUpdateTime()
+
+
+class QuotaWorksheet:
+    def __init__(self, client: SheetsClient, spreadsheet: QuotaSpreadsheet, worksheet):
+        self.client = client
+        self.spreadsheet = spreadsheet
+        self.worksheet = worksheet
+        self.title = worksheet.title
+        self.key = (spreadsheet.title, worksheet.title)
+
+    def __getattr__(self, name):
+        return getattr(self.worksheet, name)
+
+    def get_all_values(self, *args, **kwargs) -> list:
+        values = self.client.call("read", [self.key], self.worksheet.get_all_values, *args, **kwargs)
+        (cells, size) = _size(values)
+        self.client.count([self.key], cells=cells, bytes=size)
+        return values
+
+    def batch_update(self, data: list, *args, **kwargs):
+        # Cell writes are idempotent, so retrying a request that may have gone through is safe
+        response = self.client.call("write", [self.key], self.worksheet.batch_update, data, *args, **kwargs)
+        for update in data:
+            (cells, size) = _size(update["values"])
+            self.client.count([self.key], cells=cells, bytes=size)
+        return response
@@ -1,7 +1,17 @@
+from . import log
+from . import metrics
+from .matching import match_table, e164
+
 import gspread
 import polars as pl
 from yaspin import yaspin
 
+import hashlib
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
 from contextlib import contextmanager
 
 # A1 notation primer
@@ -16,72 +26,594 @@ from contextlib import contextmanager
 # - 'My Custom Sheet' refers to all the cells in "My Custom Sheet".
 
 
+# Checksum of a header and some columns (each its cells top to bottom), ignoring trailing empty
+# cells (the API leaves them out, or not, depending on the range)
+def _checksum(header: list, columns: list) -> str:
+    def trim(cells):
+        cells = list(cells)
+        while len(cells) > 0 and cells[-1] == "":
+            cells.pop()
+        return cells
+
+    return hashlib.sha1(json.dumps([trim(cells) for cells in [header] + columns]).encode()).hexdigest()
+
+
+# Normalized shadow columns (see `PolarsModel.norm`). Each kind maps a raw string column to its
+# typed, canonical form.
+NORMALIZERS = {
+    "text":  lambda c: c.cast(pl.String).str.strip_chars().str.to_lowercase(),
+    "float": lambda c: c.cast(pl.String).str.strip_chars().cast(pl.Float64, strict=False).fill_null(0.0),
+    "reg":   lambda c: c.cast(pl.String).str.to_uppercase().str.replace_all(r"[^0-9A-Z]", ""),
+    "phone": lambda c: c.cast(pl.String).map_elements(e164, return_dtype=pl.String),
+}
+
+
 class PolarsModel:
-    def __init__(self, sheet: gspread.Spreadsheet, ws_name: str):
-        self.worksheet = sheet.worksheet(ws_name)
-        sheet_data = self.worksheet.get_all_values()
+    # Short name used for local state files
+    name = "model"
+    # Worksheet the model is loaded from
+    ws_name = None
+
+    # Identity columns used by the matching heuristics
+    name_col = "Full Name"
+    reg_col = "Registration No."
+    phone_col = "WhatsApp Number"
+
+    # Columns to derive normalized shadow columns for, and their kind (see `NORMALIZERS`)
+    normalized = {}
+
+    # Optional declared schema: columns to keep (None keeps all), and dtypes for columns that
+    # shouldn't stay strings
+    columns = None
+    schema = {}
+
+    # Sheets that only ever grow at the bottom (form responses) are refreshed by fetching just the
+    # rows added since, see `append_ranges`. Whether earlier rows changed is told from the header
+    # and the `check_cols` of every row we have, which are fetched again along with them (a response
+    # edited through the form gets a new timestamp). Edits to other columns are only seen by a full
+    # fetch, which happens at least every `full_every` seconds.
+    append_only = False
+    check_cols = []
+    full_every = 60 * 60
+
+    # `worksheet` and `values` can be passed in when they were already fetched (see `load_models`)
+    def __init__(self, sheet: gspread.Spreadsheet, ws_name: str = None, worksheet: gspread.Worksheet = None, values: list = None):
+        self.worksheet = worksheet if worksheet is not None else sheet.worksheet(ws_name or self.ws_name)
+        sheet_data = values if values is not None else self.worksheet.get_all_values()
+
+        self.header = sheet_data[0] if len(sheet_data) > 0 else []
+        self.records = self._build(self.header, sheet_data[1:])
+
+        # Sheet rows the model was built from, the checksum of the header and their `check_cols`,
+        # and when the whole sheet was last fetched
+        self.fetched = {
+            "rows": len(sheet_data) - 1 if len(sheet_data) > 0 else 0,
+            "checksum": _checksum(self.header, self._check_columns(sheet_data[1:])),
+            "full_at": time.time(),
+        }
+
+        self._setup()
+
+    # Rebuild a model from a local snapshot (see `automate.snapshot`). Without a worksheet it is
+    # read-only until one is attached.
+    @classmethod
+    def from_snapshot(cls, header: list, records: pl.DataFrame, worksheet: gspread.Worksheet = None, fetched: dict = None):
+        model = cls.__new__(cls)
+        model.worksheet = worksheet
+        model.header = header
+        model.records = records
+        model.fetched = fetched
+        model._setup()
+        return model
+
+    # Derived state, once `header` and `records` are set
+    def _setup(self, norm: pl.DataFrame = None):
+        self.norm = norm if norm is not None else self._normalized(self.records)
+        self._last_named = None
+        self._blank = None
+
+        # Rows written through `_ModelGuard.cell`, and the subset whose identity columns changed
+        self.touched = set()
+        self.rekeyed = set()
+
+    # Build the frame column by column straight from the API rows, only for the columns we keep
+    def _build(self, header: list, rows: list) -> pl.DataFrame:
+        records = pl.DataFrame([
+            pl.Series(col, [row[i] for row in rows], dtype=pl.String)
+            for (i, col) in enumerate(header)
+            if self.columns is None or col in self.columns
+        ])
+
+        casts = []
+        for (col, dtype) in self.schema.items():
+            if col in records.columns:
+                c = pl.col(col)
+                if dtype.is_numeric():
+                    c = c.str.strip_chars()
+                casts.append(c.cast(dtype, strict=False))
+
+        return records.with_columns(casts)
+
+    # Shadow frame with the same rows as `records`, holding the normalized form of every column in
+    # `normalized`. Heuristics read these instead of re-parsing the raw strings.
+    def _normalized(self, records: pl.DataFrame) -> pl.DataFrame:
+        return records.select(
+            NORMALIZERS[kind](pl.col(col)).alias(col)
+            for (col, kind) in self.normalized.items()
+            if col in records.columns
+        )
+
+    # `check_cols` of some rows, as lists of cells
+    def _check_columns(self, rows: list) -> list:
+        return [[row[i] if i < len(row) else "" for row in rows]
+                for i in (self.header.index(col) for col in self.check_cols if col in self.header)]
+
+    # A1 ranges to refresh an append-only model with, given the worksheet's current grid size: the
+    # header row, the `check_cols` of the rows we have, and every row after them. None if the model
+    # wasn't built from the sheet (see `fetched`) or is due a full fetch, and has to be fetched whole.
+    def append_ranges(self, row_count: int) -> dict:
+        if not self.append_only or self.fetched is None or len(self.header) == 0:
+            return None
+        if time.time() - self.fetched.get("full_at", 0) >= self.full_every:
+            return None
 
-        self.records = pl.DataFrame(sheet_data).transpose()
-        self.records.columns = self.records.head(1).rows()[0]
-        self.records = self.records.with_row_index().filter(pl.col("index") != 0)
+        # 1-based sheet rows, the header being the first
+        last = self.fetched["rows"] + 1
+
+        def a1(start, end, first_col=1, last_col=len(self.header)):
+            return gspread.utils.absolute_range_name(self.ws_name, gspread.utils.rowcol_to_a1(start, first_col) + ":"
+                                                     + gspread.utils.rowcol_to_a1(end, last_col))
+
+        ranges = {"header": gspread.utils.absolute_range_name(self.ws_name, "1:1")}
+        for col in self.check_cols:
+            if col in self.header and last >= 2:
+                ranges[f"check:{col}"] = a1(2, last, self.col_at(col), self.col_at(col))
+        # Ranges past the end of the grid are an error, and there can't be rows there anyway
+        ranges["new"] = a1(last + 1, row_count) if row_count > last else None
+        return ranges
+
+    # New rows out of the values of `append_ranges`, and the `fetched` state including them. None
+    # if the header or the checked columns changed, in which case the sheet must be fetched whole.
+    def appended(self, values: dict) -> tuple:
+        header = values["header"][0] if len(values["header"]) > 0 else []
+
+        # Single cells of a column, empty ones coming back as empty rows
+        count = self.fetched["rows"]
+        columns = []
+        for col in self.check_cols:
+            if col in self.header:
+                cells = [row[0] if len(row) > 0 else "" for row in values.get(f"check:{col}", [])]
+                columns.append(cells + [""] * (count - len(cells)))
+
+        if _checksum(header, columns) != self.fetched["checksum"]:
+            return None
+
+        rows = gspread.utils.fill_gaps(values.get("new", []), cols=len(self.header)) if len(values.get("new", [])) > 0 else []
+        fetched = {
+            **self.fetched,
+            "rows": count + len(rows),
+            "checksum": _checksum(self.header, [old + new for (old, new) in zip(columns, self._check_columns(rows))]),
+        }
+        return (rows, fetched)
+
+    # New model with the rows of `appended` added after the ones fetched so far. Only the new rows
+    # are built and normalized.
+    def extend(self, rows: list, fetched: dict, worksheet: gspread.Worksheet = None):
+        # Blank rows `_next_free_row` may have added locally are in the sheet (and `rows`) by now
+        records = self.records.head(self.fetched["rows"])
+        norm = self.norm.head(self.fetched["rows"])
+
+        new = self._build(self.header, rows)
+
+        model = type(self).__new__(type(self))
+        model.worksheet = worksheet if worksheet is not None else self.worksheet
+        model.header = self.header
+        model.records = pl.concat([records, new.select(records.columns).cast(records.schema)])
+        model.fetched = fetched
+        model._setup(norm=pl.concat([norm, self._normalized(model.records.tail(len(rows))) if len(rows) > 0 else norm.clear()]))
+
+        return model
+
+    @property
+    def keys(self) -> pl.DataFrame:
+        # Identity columns for matching: raw name, canonical registration no. and E.164 phone
+        return pl.DataFrame([
+            self.records.get_column(self.name_col).alias("name"),
+            self.norm.get_column(self.reg_col).alias("reg"),
+            self.norm.get_column(self.phone_col).alias("phone") if self.phone_col is not None \
+                else pl.Series("phone", [None] * self.records.height, dtype=pl.String)
+        ])
+
+    @property
+    def key_cols(self) -> tuple:
+        return ("name", "reg", "phone" if self.phone_col is not None else None)
+
+    def matches(self, other=None, threshold: float = 0.0, rows: list = None, other_rows: list = None) -> pl.DataFrame:
+        # Sparse (left, right, score) table of this model's rows against `other`'s (or its own).
+        # `rows`/`other_rows` restrict either side to the given row indices. Against itself, `rows`
+        # means every pair involving one of them, still reported with left < right.
+        if other is None:
+            return match_table(self.keys, self.key_cols, threshold=threshold, left_rows=rows)
+
+        return match_table(self.keys, self.key_cols, other.keys, other.key_cols, threshold=threshold,
+                           left_rows=rows, right_rows=other_rows)
+
+    def fold(self, other=None, threshold: float = 0.0, rows: list = (), other_rows: list = (), within: set = None) -> pl.DataFrame:
+        # Matches involving one of `rows` of ours, or one of `other_rows` of `other` (our own rows
+        # again without it), as `matches` would find them. Only those rows are compared with the
+        # other side, so this costs as much as there are rows to fold in. `within` restricts our
+        # side when comparing `other_rows`.
+        if other is None:
+            return self.matches(threshold=threshold, rows=sorted(rows))
+
+        found = [self.matches(other, threshold=threshold, rows=sorted(rows))]
+        if len(other_rows) > 0:
+            found.append(self.matches(other, threshold=threshold, rows=None if within is None else sorted(within),
+                                      other_rows=sorted(other_rows)))
+        return pl.concat(found).unique(["left", "right"]).sort("left", "right")
+
+    # Recompute derived state for a cell written through `_ModelGuard.cell`
+    def _touch(self, row: int, col: str):
+        self.touched.add(row)
+        if col in (self.name_col, self.reg_col, self.phone_col):
+            self.rekeyed.add(row)
+
+        if col in self.norm.columns:
+            value = pl.select(NORMALIZERS[self.normalized[col]](pl.lit(self.records[row, col])))
+            self.norm[row, col] = value.item()
+
+        if col == self.name_col and self._last_named is not None:
+            if str(self.records[row, col]).strip() != "":
+                self._last_named = max(self._last_named, row)
+            elif row == self._last_named:
+                self._last_named = None
 
 
     def col_at(self, col_name: str):
-        # see note in `_ModelGuard.update_cell`
-        return self.records.get_column_index(col_name)
+        # 1-based column of the sheet, see note in `_ModelGuard.cell`
+        return self.header.index(col_name) + 1
+
+    # Index of the first row after the last one with a name, adding a blank row if there is none.
+    # The last named row is looked for once, `_touch` follows it from there on.
+    def _next_free_row(self) -> int:
+        if self._last_named is None:
+            names = self.records.get_column(self.name_col).cast(pl.String).str.strip_chars()
+            filled = (names != "").arg_true()
+            self._last_named = filled.max() if filled.len() > 0 else -1
+        row = self._last_named + 1
+
+        if row >= self.records.height:
+            if self._blank is None:
+                blank = pl.DataFrame([
+                    pl.Series(col, [""] if dtype == pl.String else [None], dtype=dtype)
+                    for (col, dtype) in self.records.schema.items()
+                ])
+                self._blank = (blank, blank.select(
+                    NORMALIZERS[self.normalized[col]](pl.col(col)).alias(col) for col in self.norm.columns
+                ))
+            self.records = pl.concat([self.records, self._blank[0]])
+            self.norm = pl.concat([self.norm, self._blank[1]])
 
+        return row
+
+    # `background` flushes writes from a separate thread, see `_ModelGuard`
     @contextmanager
-    def update(self):
+    def update(self, background: bool = False):
+        if self.worksheet is None:
+            raise RuntimeError(f"'{self.ws_name}' was loaded offline and is read-only")
+
+        guard = _ModelGuard(self, background)
         try:
-            guard = _ModelGuard(self)
             yield guard
         finally:
-            guard._update()
+            guard._close()
+
+
+# Merge single cells into as few rectangular ranges as possible: contiguous cells of a row become a
+# run, and identical runs on consecutive rows are stacked.
+def _ranges(cells: dict) -> list:
+    by_row = defaultdict(dict)
+    for ((row, col), value) in cells.items():
+        by_row[row][col] = value
+
+    runs = []
+    for row in sorted(by_row):
+        cols = sorted(by_row[row])
+        start = 0
+        for i in range(1, len(cols) + 1):
+            if i == len(cols) or cols[i] != cols[i - 1] + 1:
+                runs.append((row, cols[start], cols[i - 1], [by_row[row][c] for c in cols[start:i]]))
+                start = i
+
+    rects = []
+    stacks = {}
+    for (row, first, last, values) in runs:
+        rect = stacks.get((first, last))
+        if rect is not None and rect["last_row"] == row - 1:
+            rect["values"].append(values)
+            rect["last_row"] = row
+        else:
+            rect = {"row": row, "last_row": row, "first": first, "last": last, "values": [values]}
+            stacks[(first, last)] = rect
+            rects.append(rect)
+
+    batch = []
+    for rect in rects:
+        a1 = gspread.utils.rowcol_to_a1(rect["row"], rect["first"])
+        if rect["last_row"] != rect["row"] or rect["last"] != rect["first"]:
+            a1 += ":" + gspread.utils.rowcol_to_a1(rect["last_row"], rect["last"])
+        batch.append({"range": a1, "values": rect["values"]})
+    return batch
 
 
 class _ModelGuard:
-    def __init__(self, model):
+    # Pending writes are flushed once their payload reaches `max_bytes`, or the oldest of them has
+    # waited `max_delay` seconds
+    max_bytes = 256 * 1024
+    max_delay = 10.0
+
+    def __init__(self, model, background: bool = False):
         self.model = model
-        self.batch = []
+
+        # (sheet row, sheet column) -> value. A later write to the same cell replaces the earlier.
+        self.pending = {}
+        self.size = 0
+        self.since = None
+        self.lock = threading.Lock()
+
+        # Depth of `group` blocks, nothing is flushed while inside one
+        self.grouped = 0
+
+        # With `background`, flushes are handed to a worker thread so the caller never waits on
+        # the network. Its errors are raised back on the next write, or on close.
+        self.jobs = None
+        self.error = None
+        if background:
+            self.jobs = queue.Queue()
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
 
     # Update value at a specific cell index.
     #
-    # NOTE: The cell index is based on the INTERNAL DATAFRAME.
-    # Therefore, row indices start at 0 and column starts at 1.
+    # NOTE: The row index is based on the INTERNAL DATAFRAME, and starts at 0 (the header isn't
+    # part of it). Columns are looked up by name in the sheet header, and start at 1.
     def cell(self, col: str, row: int, value) -> str:
+        self._raise()
+
+        key = (row + 2, self.model.col_at(col))
+
+        # Rewriting a cell with what it already holds would only mark the sheet as modified, and
+        # have the next sync (or `--watch` poll) look at it again
+        if key not in self.pending and row < self.model.records.height and self.model.records[row, col] == value:
+            return f"{gspread.utils.rowcol_to_a1(*key)} -> {value}"
+
         self.model.records[row, col] = value
+        self.model._touch(row, col)
 
-        self.batch.append({
-            "range": gspread.utils.rowcol_to_a1(row + 2, self.model.col_at(col)),
-            "values": [[value]]
-        })
+        with self.lock:
+            if key not in self.pending:
+                self.size += 16
+            self.pending[key] = value
+            self.size += len(str(value))
 
-        if len(self.batch) > 10:
+            if self.since is None:
+                self.since = time.monotonic()
+
+        if self.size >= self.max_bytes or self._stale():
             self._update()
 
-        return f"{gspread.utils.rowcol_to_a1(row + 2, self.model.col_at(col))} -> {value}"
-    
+        return f"{gspread.utils.rowcol_to_a1(*key)} -> {value}"
+
+    # Write a new row after the last named one. `values` maps column names to values.
+    def append(self, values: dict) -> int:
+        row = self.model._next_free_row()
+        for (col, value) in values.items():
+            self.cell(col, row, value)
+        return row
+
+    # Writes made inside the block go out in the same batch, so a set of cells that only make sense
+    # together is never half written
+    @contextmanager
+    def group(self):
+        with self.lock:
+            self.grouped += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.grouped -= 1
+
+            if self.size >= self.max_bytes or self._stale():
+                self._update()
+
+    def _stale(self) -> bool:
+        return self.since is not None and time.monotonic() - self.since >= self.max_delay
+
+    def _update(self, force: bool = False):
+        with self.lock:
+            if len(self.pending) == 0 or (self.grouped > 0 and not force):
+                return
+
+            batch = _ranges(self.pending)
+            count = len(self.pending)
+            self.pending = {}
+            self.size = 0
+            self.since = None
+
+        if self.jobs is not None:
+            self.jobs.put((batch, count))
+        else:
+            with yaspin(text=f"Updating {count} cells in {len(batch)} ranges...", color="cyan"):
+                self._write(batch, count)
 
-    def _update(self):
-        if len(self.batch) > 0:
-            with yaspin(text=f"Updating {len(self.batch)} cells...", color="cyan"):
-                self.model.worksheet.batch_update(self.batch)
-            self.batch = []
+    def _write(self, batch: list, count: int):
+        with metrics.span("sheet_flush", model=self.model.name, cells=count, ranges=len(batch)):
+            self.model.worksheet.batch_update(batch)
+        metrics.count("cells_written", count, model=self.model.name)
+
+    def _work(self):
+        while True:
+            try:
+                job = self.jobs.get(timeout=self.max_delay)
+            except queue.Empty:
+                if self._stale():
+                    self._update()
+                continue
+
+            if job is None:
+                break
+
+            (batch, count) = job
+            try:
+                self._write(batch, count)
+                log.trace(f"Updated {count} cells in {len(batch)} ranges of '{self.model.ws_name}'",
+                          model=self.model.name, cells=count, ranges=len(batch))
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+    def _raise(self):
+        if self.error is not None:
+            (error, self.error) = (self.error, None)
+            raise error
+
+    def _close(self):
+        self._update(force=True)
+
+        if self.jobs is not None:
+            self.jobs.put(None)
+            self.worker.join()
+
+        self._raise()
 
 
 class FormModel(PolarsModel):
-    def __init__(self, sheet: gspread.Spreadsheet):
-        super().__init__(sheet, "Form Responses 1")
+    name = "form"
+    ws_name = "Form Responses 1"
+    reg_col = "Registration No. "
+    append_only = True
+    check_cols = ["Timestamp", "Full Name", "Registration No. ", "WhatsApp Number"]
+    normalized = {
+        "Registration No. ": "reg",
+        "WhatsApp Number": "phone",
+        "First Preference of Subsystem": "text",
+        "Second Preference of Subsystem": "text",
+    }
+
+    # The response sheet is by far the largest, and only these are ever read
+    columns = [
+        "Full Name",
+        "Registration No. ",
+        "WhatsApp Number",
+        "Branch",
+        "First Preference of Subsystem",
+        "Second Preference of Subsystem",
+    ]
+    schema = {
+        "Branch": pl.Categorical,
+        "First Preference of Subsystem": pl.Categorical,
+        "Second Preference of Subsystem": pl.Categorical,
+    }
 
 
 class ScheduleModel(PolarsModel):
-    def __init__(self, sheet: gspread.Spreadsheet):
-        super().__init__(sheet, "Interview Schedules")
+    name = "schedules"
+    ws_name = "Interview Schedules"
+    normalized = {
+        "Registration No.": "reg",
+        "WhatsApp Number": "phone",
+        "Interview Date/Time": "text",
+        "Appeared": "text",
+        "Remarks": "text",
+        "WS Sender": "text",
+    }
 
 class ScoresModel(PolarsModel):
-    def __init__(self, sheet: gspread.Spreadsheet):
-        super().__init__(sheet, "Interview Scores")
+    name = "scores"
+    ws_name = "Interview Scores"
+    phone_col = None
+    normalized = {
+        "Registration No.": "reg",
+        "Overall": "float",
+        "Interviewers": "text",
+        "Remarks": "text",
+    }
+    schema = {
+        "Overall": pl.Float64,
+    }
 
 class OldAutomatorModel(PolarsModel):
-    def __init__(self, sheet: gspread.Spreadsheet):
-        super().__init__(sheet, "Form Responses 1")
+    name = "old_automator"
+    ws_name = "Form Responses 1"
+    reg_col = "Registration No. "
+    append_only = True
+    check_cols = ["Timestamp", "Full Name", "Registration No. ", "WhatsApp Number"]
+    normalized = {
+        "Registration No. ": "reg",
+        "WhatsApp Number": "phone",
+        "MemberNotifier": "text",
+    }
+
+
+# Load models living in the same spreadsheet with one metadata request and one values request,
+# however many there are. `previous` maps model names to models loaded before: append-only ones
+# among them only get their new rows (see `PolarsModel.append_ranges`).
+def load_models(sheet: gspread.Spreadsheet, models: list, previous: dict = None) -> list:
+    previous = previous or {}
+    start = time.perf_counter()
+
+    with metrics.span("sheet_fetch", spreadsheet=sheet.title, worksheets=len(models)) as fields:
+        worksheets = {ws.title: ws for ws in sheet.worksheets()}
+
+        # {part: A1 range} of every model, a single whole-worksheet part unless it can be extended
+        requests = []
+        for model in models:
+            old = previous.get(model.name)
+            ranges = old.append_ranges(worksheets[model.ws_name].row_count) if old is not None else None
+            requests.append(ranges or {"all": gspread.utils.absolute_range_name(model.ws_name)})
+
+        flat = [a1 for ranges in requests for a1 in ranges.values() if a1 is not None]
+        response = iter(sheet.values_batch_get(flat)["valueRanges"])
+        values = [{part: next(response).get("values", []) for (part, a1) in ranges.items() if a1 is not None}
+                  for ranges in requests]
+
+        # Models whose earlier rows changed after all are fetched again, whole
+        appended = {}
+        for (i, model) in enumerate(models):
+            if "all" not in values[i]:
+                appended[i] = previous[model.name].appended(values[i])
+                if appended[i] is None:
+                    log.trace(f"Rows of '{model.ws_name}' changed, fetching it whole", model=model.name)
+
+        stale = [i for (i, result) in appended.items() if result is None]
+        if len(stale) > 0:
+            response = sheet.values_batch_get([gspread.utils.absolute_range_name(models[i].ws_name) for i in stale])
+            for (i, value_range) in zip(stale, response["valueRanges"]):
+                values[i] = {"all": value_range.get("values", [])}
+                del appended[i]
+
+        fields["appended"] = len(appended)
+
+    fetched = time.perf_counter() - start
+
+    loaded = []
+    for (i, model) in enumerate(models):
+        start = time.perf_counter()
+        worksheet = worksheets[model.ws_name]
+
+        if i in appended:
+            (rows, state) = appended[i]
+            with metrics.span("sheet_build", model=model.name, rows=len(rows), appended=True):
+                loaded.append(previous[model.name].extend(rows, state, worksheet))
+            log.trace(f"Appended {len(rows)} new rows of '{model.ws_name}' from '{sheet.title}'", model=model.name,
+                      rows=state["rows"], fetch=f"{fetched:.2f}s", build=f"{time.perf_counter() - start:.2f}s")
+            continue
+
+        sheet_data = gspread.utils.fill_gaps(values[i]["all"])
+        with metrics.span("sheet_build", model=model.name, rows=len(sheet_data) - 1):
+            loaded.append(model(sheet, worksheet=worksheet, values=sheet_data))
+
+        log.trace(f"Loaded '{model.ws_name}' from '{sheet.title}'", model=model.name, rows=len(sheet_data) - 1,
+                  fetch=f"{fetched:.2f}s", worksheets_per_request=len(models), build=f"{time.perf_counter() - start:.2f}s")
+
+    return loaded
@@ -0,0 +1,62 @@
+from . import log
+
+import json
+import os
+
+import polars as pl
+
+# Local snapshots of the loaded models.
+#
+# Every model is kept in `./.data/snapshots/` as an Arrow IPC file (`<model>.arrow`), which polars
+# can memory-map back instantly, next to a `<model>.json` with its sheet header, the declared schema
+# it was built with, the spreadsheet's modified time when it was fetched, and the rows it was
+# fetched up to (see `PolarsModel.fetched`). On startup the snapshots are used straight away and
+# only re-fetched if the spreadsheet changed since, append-only sheets just for their new rows.
+
+
+def _schema(model_cls) -> dict:
+    return {
+        "ws_name": model_cls.ws_name,
+        "columns": model_cls.columns,
+        "schema": {col: str(dtype) for (col, dtype) in model_cls.schema.items()},
+    }
+
+
+class SnapshotCache:
+    def __init__(self, path="./.data/snapshots"):
+        self.path = path
+
+    def _files(self, name: str):
+        return (os.path.join(self.path, f"{name}.arrow"), os.path.join(self.path, f"{name}.json"))
+
+    def save(self, model, modified: str = None):
+        os.makedirs(self.path, exist_ok=True)
+        (data, meta) = self._files(model.name)
+
+        try:
+            model.records.write_ipc(data + ".tmp", compression="uncompressed")
+            os.replace(data + ".tmp", data)
+        except PermissionError:
+            # Windows won't replace a file that is still memory-mapped
+            log.warn(f"Couldn't update the snapshot of '{model.ws_name}', it is still in use")
+            return
+
+        with open(meta, 'w') as f:
+            json.dump({"header": model.header, "modified": modified, "fetched": model.fetched, **_schema(type(model))}, f)
+
+    # Returns (model, modified time), or None if there is no usable snapshot
+    def load(self, model_cls):
+        (data, meta) = self._files(model_cls.name)
+
+        try:
+            with open(meta, 'r') as f:
+                meta = json.load(f)
+            if {key: meta.get(key) for key in ("ws_name", "columns", "schema")} != json.loads(json.dumps(_schema(model_cls))):
+                return None
+
+            # Uncompressed, so polars memory-maps it instead of reading it in
+            records = pl.read_ipc(data)
+        except (OSError, ValueError, pl.exceptions.PolarsError):
+            return None
+
+        return (model_cls.from_snapshot(meta["header"], records, fetched=meta.get("fetched")), meta["modified"])
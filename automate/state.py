@@ -0,0 +1,90 @@
+import json
+import os
+
+import polars as pl
+
+# Persistent state for incremental synchronization.
+#
+# Every edge of the match graph (see `automate.graph`) stores, under `./.data/sync/<edge>/`:
+# - `<model>.parquet`: the hash of every row of both models, taken when the sync pass started
+# - `<model>.keys.parquet`: the hash of the identity columns (see `PolarsModel.keys`) of every row of
+#   both models, taken when the sync pass ended
+# - `pairs.parquet`: the (left, right, score) matches between them
+# - `meta.json`: a fingerprint of the headers and settings the above were computed with
+#
+# On the next pass only rows that were added or changed since then, plus rows matched to them, are
+# re-evaluated, and only rows whose identity changed are matched again. Row hashes are taken when the
+# pass *starts*, so anything written during the pass is picked up again next time. The pass already
+# matched what it wrote itself though, so identities are as of its end.
+
+STATE_VERSION = 4
+
+
+def row_hashes(model) -> pl.Series:
+    return model.records.hash_rows(seed=0)
+
+def key_hashes(model) -> pl.Series:
+    return model.keys.hash_rows(seed=0)
+
+def fingerprint(models: list, **extra) -> dict:
+    return {
+        "version": STATE_VERSION,
+        "polars": pl.__version__,   # row hashes are only stable within a polars version
+        "schema": {model.name: model.records.columns for model in models},
+        **extra
+    }
+
+def changed_rows(current: pl.Series, stored: pl.Series):
+    # Rows that were added or edited, or None if rows went missing (positions can't be trusted)
+    if current.len() < stored.len():
+        return None
+
+    edited = (current.head(stored.len()) != stored).arg_true().to_list()
+    return edited + list(range(stored.len(), current.len()))
+
+
+class SyncState:
+    def __init__(self, path="./.data/sync", enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+
+    # Returns (row hashes by model name, key hashes by model name, pairs), or None if nothing usable
+    # is stored
+    def load(self, name: str, models: list, **extra):
+        if not self.enabled:
+            return None
+
+        base = os.path.join(self.path, name)
+
+        try:
+            with open(os.path.join(base, "meta.json"), 'r') as f:
+                meta = json.load(f)
+            if meta != json.loads(json.dumps(fingerprint(models, **extra))):
+                return None
+
+            hashes = {model.name: pl.read_parquet(os.path.join(base, f"{model.name}.parquet"))["hash"] for model in models}
+            keys = {model.name: pl.read_parquet(os.path.join(base, f"{model.name}.keys.parquet"))["hash"] for model in models}
+            pairs = pl.read_parquet(os.path.join(base, "pairs.parquet"))
+        except (OSError, ValueError, pl.exceptions.PolarsError):
+            return None
+
+        return (hashes, keys, pairs)
+
+    def save(self, name: str, models: list, hashes: dict, key_hashes: dict, pairs: pl.DataFrame, **extra):
+        base = os.path.join(self.path, name)
+        os.makedirs(base, exist_ok=True)
+
+        # The previous fingerprint goes first, it would otherwise vouch for a half-written state
+        try:
+            os.remove(os.path.join(base, "meta.json"))
+        except FileNotFoundError:
+            pass
+
+        for model in models:
+            pl.DataFrame({"hash": hashes[model.name]}).write_parquet(os.path.join(base, f"{model.name}.parquet"))
+            pl.DataFrame({"hash": key_hashes[model.name]}).write_parquet(os.path.join(base, f"{model.name}.keys.parquet"))
+        pairs.write_parquet(os.path.join(base, "pairs.parquet"))
+
+        # Written last, so a half-written state fails the fingerprint check next time
+        with open(os.path.join(base, "meta.json"), 'w') as f:
+            json.dump(fingerprint(models, **extra), f)
@@ -1,32 +1,64 @@
 from . import log
+from . import metrics
 from .config import Config
+from .pacing import Pacer
 from .sheets import *
 
+import json
 import os
+import queue
 import sys
+import threading
+import time
 
 from contextlib import contextmanager
 
 from alright import WhatsApp
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.chrome.service import Service as ChromiumService
 from webdriver_manager.chrome import ChromeDriverManager
 from webdriver_manager.core.os_manager import ChromeType
 from selenium.webdriver.chrome.options import Options as ChromeOptions
 
 import gspread
-import phonenumbers
-from phonenumbers import PhoneNumber
 
 
 TEST_GUARD = False
 
+# Where the resolved chromedriver path is kept, see `chromedriver`
+DRIVER_CACHE = "./.data/chromedriver.json"
+_driver_lock = threading.Lock()
+
+
+# Path of a chromedriver for the installed Chromium. Resolving one asks the network for the latest
+# release, so the result is kept in `DRIVER_CACHE` and reused until it stops working with the
+# browser (`refresh`, see `WhatsappInstance.setup_browser`).
+def chromedriver(refresh: bool = False) -> str:
+    with _driver_lock:
+        if not refresh:
+            try:
+                with open(DRIVER_CACHE, 'r') as f:
+                    path = json.load(f)["path"]
+                if os.path.isfile(path):
+                    return path
+            except (OSError, ValueError, KeyError):
+                pass
+
+        path = ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install()
+
+        os.makedirs(os.path.dirname(DRIVER_CACHE), exist_ok=True)
+        with open(DRIVER_CACHE, 'w') as f:
+            json.dump({"path": path}, f)
+        return path
+
 
 class WhatsappInstance:
-    def __init__(self, config: Config):
+    # `sender` picks the browser profile (`./.data/<sender>`), the safety file's name by default
+    def __init__(self, config: Config, sender: str = None):
         self.config = config
+        self.sender = sender or config.safety.name
         self.whatsapp = WhatsApp(self.setup_browser())
-        pass
 
     @property
     def chrome_options(self) -> ChromeOptions:
@@ -35,20 +67,35 @@ class WhatsappInstance:
         chrome_options = ChromeOptions()
         if sys.platform == "win32":
             chrome_options.add_argument("--profile-directory=Default")
-            chrome_options.add_argument(f"--user-data-dir={data_path}\\{self.config.safety.name}")
+            chrome_options.add_argument(f"--user-data-dir={data_path}\\{self.sender}")
         else:
             chrome_options.add_argument("start-maximized")
-            chrome_options.add_argument(f"--user-data-dir={data_path}/{self.config.safety.name}")
+            chrome_options.add_argument(f"--user-data-dir={data_path}/{self.sender}")
         return chrome_options
 
     def setup_browser(self) -> webdriver.Chrome:
-        chromium = ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install()
-        driver = webdriver.Chrome(service=ChromiumService(chromium), options=self.chrome_options)
+        try:
+            return webdriver.Chrome(service=ChromiumService(chromedriver()), options=self.chrome_options)
+        except WebDriverException as e:
+            # Most likely the browser updated past the cached driver
+            log.trace(f"Couldn't start the browser with the cached driver, resolving it again: {e.msg}")
+            return webdriver.Chrome(service=ChromiumService(chromedriver(refresh=True)), options=self.chrome_options)
 
-        return driver
+    # Close the browser. Any call blocked on it fails right away.
+    def quit(self):
+        try:
+            self.whatsapp.browser.quit()
+        except Exception as e:
+            log.warn(f"Couldn't close the browser cleanly: {e}")
 
+    # Replace a stuck browser with a fresh one. The profile (and so the login) is kept.
+    def restart(self):
+        self.quit()
+        self.whatsapp = WhatsApp(self.setup_browser())
+
+    # `num` is an E.164 formatted phone number
     @contextmanager
-    def direct(self, num: PhoneNumber):
+    def direct(self, num: str):
         try:
             guard = _WGuard(self, num, self.config)
             yield guard
@@ -57,18 +104,203 @@ class WhatsappInstance:
 
 
 class _WGuard:
-    def __init__(self, whatsapp: WhatsappInstance, num: PhoneNumber, config: Config):
+    def __init__(self, whatsapp: WhatsappInstance, num: str, config: Config):
         self.instance = whatsapp
         self.num = num
         self.config = config
 
     def send(self, message: str):
-        num_f = phonenumbers.format_number(self.num, phonenumbers.PhoneNumberFormat.E164).lstrip('+')
+        num_f = self.num.lstrip('+')
 
         if TEST_GUARD:
             num_f = self.config.safety.num
 
-        log.info(num_f)
+        log.info(num_f, sender=self.instance.sender)
+
+        # `send_direct_message`, in its stages
+        with metrics.span("whatsapp_open_chat", sender=self.instance.sender):
+            self.instance.whatsapp.find_user(num_f)
+        with metrics.span("whatsapp_send", sender=self.instance.sender):
+            self.instance.whatsapp.send_message(message)
+        with metrics.span("whatsapp_wait_tick", sender=self.instance.sender):
+            self.instance.whatsapp.wait_until_message_successfully_sent()
+
+
+class SendJob:
+    # `key` is anything the caller wants to get back with the result
+    def __init__(self, num: str, message: str, key=None):
+        self.num = num
+        self.message = message
+        self.key = key
+
+        # Filled in by the worker once `done` is set
+        self.sender = None
+        self.ok = False
+        self.timed_out = False
+        self.error = None
+        self.seconds = 0.0
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        return self
+
+
+# Owns one browser for as long as it lives and sends queued messages on it, paced by its own
+# `Pacer`.
+#
+# Each message gets `whatsapp.timeout` seconds. Past that, the watchdog closes the browser under the
+# stuck send (which makes it fail), and the browser is restarted before the next job. The worker
+# itself keeps running.
+#
+# Workers of a `WhatsappPool` share their `jobs` queue, and report finished jobs on `results`.
+class WhatsappWorker:
+    def __init__(self, config: Config, sender: str = None, timeout: float = None,
+                 jobs: queue.Queue = None, results: queue.Queue = None):
+        self.config = config
+        self.sender = sender or config.safety.name
+        self.timeout = float(timeout or config.records["whatsapp"]["timeout"])
+        self.pacer = Pacer.from_config(config)
+
+        self.instance = None
+        self.current = None
+        self.lock = threading.Lock()
+
+        self.jobs = jobs if jobs is not None else queue.Queue()
+        self.results = results
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def submit(self, num: str, message: str, key=None) -> SendJob:
+        job = SendJob(num, message, key)
+        self.jobs.put(job)
+        return job
+
+    def send(self, num: str, message: str) -> SendJob:
+        return self.submit(num, message).wait()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+        if self.instance is not None:
+            self.instance.quit()
+
+    def _expire(self, job: SendJob):
+        with self.lock:
+            if self.current is not job:
+                return
+            job.timed_out = True
+
+        log.warn(f"[{self.sender}] Sending to {job.num} timed out, restarting the browser", sender=self.sender, timeout=self.timeout)
+        self.instance.quit()
+
+    def _work(self):
+        # Start the browser before the first job comes in
+        try:
+            self.instance = WhatsappInstance(self.config, self.sender)
+        except Exception as e:
+            log.warn(f"[{self.sender}] Couldn't start the browser: {e}")
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            job.sender = self.sender
+            self.pacer.wait()
+
+            start = time.perf_counter()
+            sent = False
+            try:
+                if self.instance is None:
+                    self.instance = WhatsappInstance(self.config, self.sender)
+
+                with self.lock:
+                    self.current = job
+                watchdog = threading.Timer(self.timeout, self._expire, args=(job,))
+                watchdog.start()
+
+                try:
+                    with self.instance.direct(job.num) as dm:
+                        dm.send(job.message)
+                        # Done before the watchdog gets the lock, so it leaves this job alone
+                        with self.lock:
+                            self.current = None
+                        sent = True
+                finally:
+                    watchdog.cancel()
+                    with self.lock:
+                        self.current = None
+            except Exception as e:
+                job.error = e
+
+            # A message that went through counts as sent, even if the watchdog fired as it did (and
+            # the browser is restarted below). Retrying it would message the candidate twice.
+            job.ok = sent
+
+            job.seconds = time.perf_counter() - start
+            self.pacer.record(job.seconds, job.ok)
+
+            metrics.count("messages_sent" if job.ok else "messages_failed", sender=self.sender)
+            metrics.event("span", "whatsapp_job", sender=self.sender, seconds=round(job.seconds, 6), ok=job.ok,
+                          timed_out=job.timed_out, error=None if job.error is None else repr(job.error),
+                          delay=round(self.pacer.delay, 3))
+
+            if job.timed_out:
+                try:
+                    self.instance.restart()
+                except Exception as e:
+                    log.warn(f"[{self.sender}] Couldn't restart the browser: {e}")
+                    self.instance = None
+
+            job.done.set()
+            if self.results is not None:
+                self.results.put(job)
+
+
+# Several workers, one per logged-in profile, taking jobs from the same queue. Whichever is free
+# sends the next message, so each paces itself and a slow one doesn't hold the others up.
+class WhatsappPool:
+    def __init__(self, config: Config, senders: list = None):
+        senders = senders or config.records["whatsapp"].get("senders") or [config.safety.name]
+
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.workers = [WhatsappWorker(config, sender, jobs=self.jobs, results=self.results) for sender in senders]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def size(self) -> int:
+        return len(self.workers)
+
+    def submit(self, num: str, message: str, key=None) -> SendJob:
+        job = SendJob(num, message, key)
+        self.jobs.put(job)
+        return job
+
+    # Next finished job from any worker, or None if there is none within `timeout` seconds
+    def result(self, timeout: float = None) -> SendJob:
+        try:
+            return self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
 
-        self.instance.whatsapp.send_direct_message(num_f, message, saved=False)
-        self.instance.whatsapp.wait_until_message_successfully_sent()
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.thread.join()
+            if worker.instance is not None:
+                worker.instance.quit()
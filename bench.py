@@ -0,0 +1,300 @@
+import warnings
+
+# Spinners aren't shown in a benchmark anyway (and they're set up when `main` is imported)
+warnings.filterwarnings("ignore", module="yaspin")
+
+from automate import metrics
+from automate.fake import FakeClient
+import main
+
+from contextlib import redirect_stdout
+import argparse
+import atexit
+import os
+import random
+import tempfile
+import time
+import types
+
+import polars as pl
+
+# Benchmarks for the synchronization heuristics, against in-memory sheets (see `automate.fake`).
+#
+#   python bench.py                          # 1k and 5k form responses
+#   python bench.py 1000 --dups 0.1 --latency 0.2
+#
+# For every size it loads synthetic sheets, then times `sync_all` stage by stage, once as a full
+# pass and once more incrementally, after 1% more form responses came in. Wall time, API calls and
+# cells read and written are reported per stage.
+#
+#   python bench.py 1000 --check             # match_table against scoring every pair
+#
+# With `--check`, the matches of every pair of sheets `match_sheets` matches are compared with those
+# of scoring every pair one by one instead, at both thresholds of the heuristics.
+
+SUBSYSTEM = "Sensing And Automation"
+SUBSYSTEMS = [SUBSYSTEM, "Mechanical", "Aerodynamics", "Electronics"]
+
+FIRST = ["Aditya", "Rahul", "Mohammed", "Priya", "Sneha", "Arjun", "Kshitij", "Ananya", "Rohan", "Vikram",
+         "Ishaan", "Meera", "Karthik", "Divya", "Siddharth", "Pooja", "Nikhil", "Aarav", "Tanvi", "Harsh",
+         "Aman", "Shreya", "Varun", "Kavya", "Yash", "Riya", "Pranav", "Nandini", "Aniket", "Sanjana",
+         "Abhishek", "Lakshmi", "Gaurav", "Swathi", "Tejas", "Aishwarya", "Manish", "Deepika", "Omkar", "Fatima"]
+LAST = ["Sharma", "Kumar", "Aslam", "Rao", "Iyer", "Nair", "Gupta", "Reddy", "Menon", "Shetty",
+        "Patel", "Singh", "Das", "Bhat", "Joshi", "Kulkarni", "Pillai", "Hegde", "Mishra", "Chatterjee",
+        "Verma", "Agarwal", "Kamath", "Pai", "Banerjee", "Naidu", "Saxena", "Khan", "Jain", "Desai"]
+MIDDLE = ["", "", "", "", "S. ", "K. ", "R. ", "M. ", "A. ", "P. "]
+BRANCHES = ["CSE", "ECE", "EEE", "Mechanical", "Aeronautical", "Chemical"]
+
+FORM_HEADER = ["Timestamp", "Email Address", "Full Name", "Registration No. ", "WhatsApp Number", "Branch",
+               "First Preference of Subsystem", "Second Preference of Subsystem", "Why Manas?"]
+SCHEDULE_HEADER = ["Full Name", "Registration No.", "WhatsApp Number", "Branch", "First Preference of Subsystem",
+                   "Interview Date/Time", "Appeared", "Remarks", "WS Sender"]
+SCORES_HEADER = ["Full Name", "Registration No.", "Overall", "Interviewers", "Remarks"]
+OLD_HEADER = ["Timestamp", "Full Name", "Registration No. ", "WhatsApp Number", f"Notified_{SUBSYSTEM}", "MemberNotifier"]
+
+
+def typo(text: str, rng: random.Random) -> str:
+    # One dropped, swapped or replaced character
+    if len(text) < 3:
+        return text
+
+    i = rng.randrange(1, len(text) - 1)
+    kind = rng.randrange(3)
+    if kind == 0:
+        return text[:i] + text[i + 1:]
+    if kind == 1:
+        return text[:i - 1] + text[i] + text[i - 1] + text[i + 1:]
+    return text[:i] + rng.choice("aeiounrst") + text[i + 1:]
+
+
+def near(person: dict, rng: random.Random) -> dict:
+    # The same person entered again, slightly differently
+    person = dict(person)
+    if rng.random() < 0.5:
+        person["name"] = typo(person["name"], rng)
+    else:
+        person["reg"] = typo(person["reg"], rng)
+    return person
+
+
+def generate(size: int, dups: float, scheduled: float, seed: int = 0) -> dict:
+    """Synthetic sheets with `size` form responses.
+
+    A `dups` fraction of responses, schedule rows and score rows are near duplicates of an earlier
+    person, and `scheduled` of the subsystem's candidates are already in the interview sheets.
+    """
+    rng = random.Random(seed)
+
+    people = []
+    form = [FORM_HEADER]
+
+    for n in range(size):
+        if len(people) > 0 and rng.random() < dups:
+            person = near(rng.choice(people), rng)
+        else:
+            person = {
+                "name": f"{rng.choice(FIRST)} {rng.choice(MIDDLE)}{rng.choice(LAST)}",
+                "reg": f"{rng.choice([22, 23, 24])}{rng.randrange(10 ** 7):07d}",
+                "phone": f"{rng.choice([6, 7, 8, 9])}{rng.randrange(10 ** 9):09d}",
+                "branch": rng.choice(BRANCHES),
+                "prefs": rng.sample(SUBSYSTEMS, 2),
+            }
+            people.append(person)
+
+        form.append([f"{n}", f"{n}@example.com", person["name"], person["reg"], person["phone"], person["branch"],
+                     *person["prefs"], "..."])
+
+    candidates = [p for p in people if SUBSYSTEM in p["prefs"]]
+    seen = [p for p in candidates if rng.random() < scheduled]
+
+    schedules = [SCHEDULE_HEADER]
+    scores = [SCORES_HEADER]
+
+    for person in seen:
+        entry = near(person, rng) if rng.random() < dups else person
+        appeared = rng.random() < 0.6
+
+        schedules.append([entry["name"], entry["reg"], f"+91 {entry['phone']}", entry["branch"], person["prefs"][0],
+                          "Notified: 01/08/2024, 10:00 AM", "yes" if appeared and rng.random() < 0.5 else "",
+                          "No Show" if not appeared and rng.random() < 0.3 else "", "Bench"])
+
+        for _ in range(2 if rng.random() < dups else 1):
+            overall = rng.choice(["0", "3", "3.5", "4", "4.5"]) if appeared else "0"
+            scores.append([entry["name"], entry["reg"], overall, "A, B" if overall != "0" else "", ""])
+            entry = near(person, rng)
+
+    old = [OLD_HEADER] + [[f"{n}", p["name"], p["reg"], p["phone"], "Notified: x", "Old"]
+                          for (n, p) in enumerate(seen[:len(seen) // 10])]
+
+    return {
+        "form": ("Responses", {"Form Responses 1": form}),
+        "interviews": ("Interviews", {"Interview Schedules": schedules, "Interview Scores": scores}),
+        "old_automator": ("Old Automator", {"Form Responses 1": old}),
+    }
+
+
+def respond(spreadsheet, count: int, seed: int = 0):
+    # `count` more form responses, people who already answered filling the form again
+    rng = random.Random(seed + 1)
+    ws = spreadsheet.worksheet("Form Responses 1")
+    for _ in range(count):
+        row = list(rng.choice(ws.rows[1:]))
+        row[0] = f"{len(ws.rows) - 1}"
+        ws.rows.append(row)
+    spreadsheet.modified += 1
+
+
+class Stages:
+    def __init__(self, client: FakeClient, **labels):
+        self.client = client
+        self.labels = labels
+        self.rows = []
+
+    def run(self, stage: str, function):
+        before = self.client.stats()
+        start = time.perf_counter()
+
+        # The heuristics log every row they touch
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            result = function()
+
+        after = self.client.stats()
+        self.rows.append({
+            **self.labels,
+            "stage": stage,
+            "seconds": time.perf_counter() - start,
+            "api calls": after["calls"] - before["calls"],
+            "cells read": after["reads"] - before["reads"],
+            "cells written": after["cells"] - before["cells"],
+        })
+        return result
+
+
+def bench(size: int, args) -> list:
+    client = FakeClient(latency=args.latency, errors=args.errors, seed=args.seed)
+    for (url, (title, worksheets)) in generate(size, args.dups, args.scheduled, args.seed).items():
+        client.add(url, title, worksheets)
+
+    config = types.SimpleNamespace(records={
+        "subsystem": SUBSYSTEM,
+        "sheets": {url: url for url in main.SHEETS},
+    })
+
+    results = []
+
+    for (label, full) in (("full", True), ("incremental", False)):
+        stages = Stages(client, rows=size, run=label)
+
+        # Loading is only timed once, the second pass refreshes the loaded models with the new
+        # responses (just those are fetched, along with the columns checked for edits to earlier
+        # ones, the form being append-only)
+        if full:
+            auto = stages.run("load", lambda: main.Automator(config, client=client))
+        else:
+            modified = {key: str(client.spreadsheets[key].modified) for key in main.SHEETS}
+            respond(client.spreadsheets["form"], max(1, size // 100), args.seed)
+            stages.run("refresh", lambda: auto._refresh(modified))
+
+        auto.state.enabled = not full
+        try:
+            # Saved like `sync_all` does, for the incremental pass to start from
+            with auto.matching(save=True) as graph:
+                stages.run("matching", lambda: auto.match_sheets(graph))
+                for h in auto.heuristics():
+                    stages.run(h.__name__, h)
+        finally:
+            auto.state.enabled = True
+
+        total = {key: sum(row[key] for row in stages.rows) for key in ("seconds", "api calls", "cells read", "cells written")}
+        results += stages.rows + [{**stages.labels, "stage": "total", **total}]
+
+    return results
+
+
+def check(size: int, args) -> list:
+    client = FakeClient(seed=args.seed)
+    for (url, (title, worksheets)) in generate(size, args.dups, args.scheduled, args.seed).items():
+        client.add(url, title, worksheets)
+
+    config = types.SimpleNamespace(records={
+        "subsystem": SUBSYSTEM,
+        "sheets": {url: url for url in main.SHEETS},
+    })
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        auto = main.Automator(config, client=client)
+
+    results = []
+
+    for (a, b) in ((auto.form, auto.schedules), (auto.form, auto.scores), (auto.scores, None), (auto.scores, auto.schedules)):
+        left = a.keys.rows()
+        right = (a if b is None else b).keys.rows()
+        use_phone = a.phone_col is not None and (b is None or b.phone_col is not None)
+
+        for threshold in (0.82 * 6, 0.90 * 6):
+            start = time.perf_counter()
+            found = set(a.matches(b, threshold=threshold).select("left", "right").iter_rows())
+            seconds = time.perf_counter() - start
+
+            expected = set()
+            for (n, (a_name, a_reg, a_ph)) in enumerate(left):
+                for m in range(n + 1 if b is None else 0, len(right)):
+                    (b_name, b_reg, b_ph) = right[m]
+                    if not use_phone:
+                        a_ph = b_ph = None
+                    if main.Automator.duplicate_score(a_name, a_reg, a_ph, b_name, b_reg, b_ph) > threshold:
+                        expected.add((n, m))
+
+            results.append({
+                "rows": size,
+                "edge": f"{a.name}-{(a if b is None else b).name}",
+                "threshold": threshold,
+                "seconds": seconds,
+                "matches": len(expected),
+                "missed": len(expected - found),
+                "extra": len(found - expected),
+            })
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the synchronization heuristics against in-memory sheets.")
+    parser.add_argument("sizes", nargs="*", type=int, default=[1_000, 5_000], help="form responses to generate")
+    parser.add_argument("--dups", type=float, default=0.05, help="near-duplicate rate of every sheet")
+    parser.add_argument("--scheduled", type=float, default=0.5, help="fraction of candidates already in the interview sheets")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per API call")
+    parser.add_argument("--errors", type=float, default=0.0, help="probability of a quota error per API call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="also write the results to this CSV file")
+    parser.add_argument("--check", action="store_true", help="check the matches against scoring every pair instead")
+    args = parser.parse_args()
+
+    results = []
+    out = os.path.abspath(args.out) if args.out is not None else None
+
+    # Sync state and snapshots go to ./.data, keep them out of the real one (and apart per size).
+    # Metrics too, which would otherwise be exported at exit, back in the real working directory.
+    atexit.unregister(metrics.export)
+    metrics.PATH = tempfile.mkdtemp(prefix="bench-metrics-")
+    cwd = os.getcwd()
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                results += (check if args.check else bench)(size, args)
+            finally:
+                os.chdir(cwd)
+    metrics.export()
+
+    results = pl.DataFrame(results).with_columns(pl.col("seconds").round(3))
+
+    with pl.Config(tbl_rows=-1, tbl_hide_dataframe_shape=True, tbl_hide_column_data_types=True):
+        print(results)
+
+    print(f"Metrics of the run are in {metrics.PATH}")
+
+    if out is not None:
+        results.write_csv(out)
+
+    if args.check and results.filter((pl.col("missed") > 0) | (pl.col("extra") > 0)).height > 0:
+        raise SystemExit("match_table disagrees with scoring every pair")
@@ -1,25 +1,40 @@
 import automate
 from automate import Config
-from automate import WhatsappInstance
 import automate.log
+import automate.metrics
+import automate.graph
+import automate.matching
+import automate.planning
 from automate.sheets import *
-
-from difflib import SequenceMatcher
+from automate.graph import MatchGraph
+from automate.journal import SendJournal
+from automate.pacing import backoff
+from automate.quota import SheetsClient
+from automate.snapshot import SnapshotCache
+from automate.state import SyncState, changed_rows, row_hashes
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import timedelta
-import math
-import multiprocessing
+from typing import TYPE_CHECKING
+import copy
+import gc
+import heapq
+import os
+import sys
+import threading
 import traceback
 import time
 
-import dateparser
 import gspread
-import phonenumbers
-from phonenumbers import PhoneNumber
 import polars as pl
-import timelength
 
 from yaspin import yaspin
 
+# Only imported when scheduling, see `run_scheduling`
+if TYPE_CHECKING:
+    from automate.whatsapp import WhatsappPool
+
 
 def print_startup():
     print("Welcome to the Manas Interview Automator (sna edition).")
@@ -35,212 +50,498 @@ def print_help():
     print("              • Appearance marker from score sheet -> schedule")
     print("              • Reschedule marker from schedule -> score sheet")
     print("              • No-shows from schedule -> score sheet")
+    print("              Only rows changed since the last sync are re-checked.")
+    print(" `sync_all_full` - Same as `sync_all`, but re-checks every row.")
+    print(" `sync_subsystems` - `sync_all` for every subsystem in settings.yaml at once, sharing the form.")
+    print(" `plan` - Preview (and export) which candidates get which interview slot.")
+    print(" `schedule` - Plan a block, then message every candidate about their slot.")
+    print(" `score_conflicts` - Duplicate score rows whose overalls disagree (sheet rows).")
+    print(" `api_stats` - Sheets API calls, retries, cells and bytes per sheet so far.")
+    print()
+    print("Run with `--offline` to work from the local snapshots, read-only.")
+    print("Run with `--watch` to keep syncing whatever changes in the sheets, unattended.")
+
+
+# Models loaded from each spreadsheet in `config.records["sheets"]`. Each model ends up as the
+# `Automator` attribute of its name.
+SHEETS = {
+    "form": [FormModel],
+    "interviews": [ScheduleModel, ScoresModel],
+    "old_automator": [OldAutomatorModel],
+}
+
+# Spreadsheets every subsystem has in common. In a multi-subsystem run (see `Automator.teams`) they
+# are only loaded once, by the first subsystem (see `Automator.subsystems`).
+SHARED = ("form", "old_automator")
+
+# Spreadsheets only loaded once one of their models is used. The old automator sheet is only read by
+# `sync_notified`.
+LAZY = ("old_automator",)
+
+
+def partition(form: FormModel) -> dict:
+    # Rows of the form by subsystem (lowercase), each response counting for both its preferences
+    return {
+        subsystem: rows
+        for (subsystem, rows) in form.norm.select("First Preference of Subsystem", "Second Preference of Subsystem")
+                                          .with_row_index("row")
+                                          .unpivot(index="row", value_name="subsystem")
+                                          .group_by("subsystem").agg(pl.col("row").unique().sort())
+                                          .iter_rows()
+    }
+
+
+def spinner(text: str, **kwargs):
+    # Only the main thread owns the terminal, subsystems synced in parallel just log
+    if threading.current_thread() is not threading.main_thread():
+        return nullcontext()
+    return yaspin(text=text, **kwargs)
+
+
+def last_update(sheet: gspread.Spreadsheet):
+    # Modified time from Drive, or None if we can't tell (the sheet is then always re-fetched)
+    try:
+        return sheet.get_lastUpdateTime()
+    except gspread.exceptions.GSpreadException:
+        return None
 
 
 class Automator:
+    # With a `parent`, the `SHARED` spreadsheets are the parent's (and its models are used as they
+    # are refreshed), and so are the API client and its quota
     @yaspin(text="Loading data...", color="cyan")
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, offline: bool = False, client=None, parent=None):
         self.config = config
-        self.sac = gspread.service_account(filename="credentials.json")
+        self.offline = offline
+        self.parent = parent
+        self.sheets = {key: models for (key, models) in SHEETS.items()
+                       if key not in LAZY and (parent is None or key not in SHARED)}
+
+        # Anything with gspread's `open_by_url` (see `automate.fake`), or the service account. All
+        # calls go through `sheets_api`, which keeps them within quota.
+        self.client = client
+        self.sheets_api = None
+        self.lock = threading.RLock()
+
+        # Other subsystems synced along with this one, see `teams`
+        self.children = None
+        self._partition = None
+
+        # Incremental sync state and snapshots, kept per subsystem since the interview sheets are
+        # per subsystem
+        subsystem = config.records["subsystem"].casefold().strip().replace(" ", "_")
+        self.state = SyncState(f"./.data/sync/{subsystem}")
+        self.snapshots = SnapshotCache(f"./.data/snapshots/{subsystem}")
+        self.journal = SendJournal(f"./.data/journal/{subsystem}.jsonl")
+        self.reports = f"./.data/reports/{subsystem}"
+        self.graph = None
+
+        self.refresher = None
+        self.refresh_error = None
+
+        # Spreadsheets opened so far, and their modified times when their models were loaded
+        self.spreadsheets = {}
+        self.modified = {}
+
+        # Start from the local snapshots if we have all of them, and only go to the API for
+        # spreadsheets that changed since. That happens in the background, see `wait`.
+        cached = {key: [self.snapshots.load(model) for model in models] for (key, models) in self.sheets.items()}
+        modified = {}
+
+        if all(snapshot is not None for snapshots in cached.values() for snapshot in snapshots):
+            for (key, snapshots) in cached.items():
+                for (model, _) in snapshots:
+                    setattr(self, model.name, model)
+                modified[key] = snapshots[0][1] if all(t == snapshots[0][1] for (_, t) in snapshots) else None
+            self.modified = dict(modified)
+
+            if not offline:
+                self.refresher = threading.Thread(target=self._refresh_background, args=(modified,), daemon=True)
+                self.refresher.start()
+
+        elif offline:
+            raise RuntimeError("No local snapshot to work offline from, run online once first")
+
+        else:
+            self._refresh(modified)
+
+    def _refresh(self, modified: dict, keys: list = None) -> list:
+        # Open every spreadsheet (or those of `keys`) concurrently, reload those modified since their
+        # snapshot (worksheets of the same spreadsheet share a single values request) and just
+        # reattach the rest. Returns the keys of the reloaded ones.
+        targets = {key: self.sheets[key] for key in (keys or self.sheets)}
+        api = self.api()
+        urls = self.config.records["sheets"]
+
+        with ThreadPoolExecutor() as pool:
+            missing = [key for key in targets if key not in self.spreadsheets]
+            self.spreadsheets.update(zip(missing, pool.map(lambda key: api.open_by_url(urls[key]), missing)))
+            sheets = self.spreadsheets
+            times = dict(zip(targets, pool.map(last_update, [sheets[key] for key in targets])))
+
+            stale = [key for key in targets if times[key] is None or modified.get(key) != times[key]]
+            loads = {key: pool.submit(load_models, sheets[key], targets[key], self.loaded(targets[key])) for key in stale}
+
+            # Only models from a snapshot still need their worksheets
+            detached = [key for key in targets if key not in loads
+                        and any(getattr(self, model.name).worksheet is None for model in targets[key])]
+            fresh = {key: pool.submit(sheets[key].worksheets) for key in detached}
+
+            for (key, models) in targets.items():
+                if key in loads:
+                    models = loads[key].result()
+                    for model in models:
+                        self.snapshots.save(model, times[key])
+                elif key in fresh:
+                    worksheets = {ws.title: ws for ws in fresh[key].result()}
+                    models = [getattr(self, model.name) for model in models]
+                    for model in models:
+                        model.worksheet = worksheets[model.ws_name]
+                else:
+                    continue
+
+                for model in models:
+                    setattr(self, model.name, model)
+                self.modified[key] = times[key]
+
+        automate.log.trace(f"Refreshed {', '.join(stale) if len(stale) > 0 else 'nothing'} from the API")
+        return stale
+
+    def api(self) -> SheetsClient:
+        # The quota-aware client, shared by all subsystems of a run since the quota is per user
+        if self.parent is not None:
+            return self.parent.api()
+
+        with self.lock:
+            if self.sheets_api is None:
+                if self.client is None:
+                    self.client = gspread.service_account(filename="credentials.json")
+                self.sheets_api = SheetsClient.from_config(self.client, self.config)
+            return self.sheets_api
+
+    def __getattr__(self, name):
+        # Models of the `SHARED` spreadsheets come from the parent, whatever it last loaded, and
+        # those of `LAZY` ones are loaded on first use
+        parent = self.__dict__.get("parent")
+        if parent is not None and name in [model.name for key in SHARED for model in SHEETS[key]]:
+            return getattr(parent, name)
+
+        for key in LAZY:
+            if "sheets" in self.__dict__ and key not in self.sheets and name in [model.name for model in SHEETS[key]]:
+                self._load(key)
+                return self.__dict__[name]
+
+        raise AttributeError(name)
+
+    def _load(self, key: str):
+        # Load a `LAZY` spreadsheet like the others at startup: from its snapshot if there is one,
+        # refreshed if it changed since
+        with self.lock:
+            if key in self.sheets:
+                return
+
+            snapshots = [self.snapshots.load(model) for model in SHEETS[key]]
+            modified = None
+
+            if all(snapshot is not None for snapshot in snapshots):
+                for (model, _) in snapshots:
+                    setattr(self, model.name, model)
+                modified = snapshots[0][1] if all(t == snapshots[0][1] for (_, t) in snapshots) else None
+            elif self.offline:
+                raise RuntimeError(f"No local snapshot of '{key}' to work offline from, run online once first")
+
+            self.sheets = {**self.sheets, key: SHEETS[key]}
+            if not self.offline:
+                with yaspin(text=f"Loading {key}...", color="cyan"):
+                    self._refresh({key: modified}, [key])
+
+    def loaded(self, models: list) -> dict:
+        # Models already loaded (from a snapshot or an earlier refresh), by name
+        return {model.name: getattr(self, model.name) for model in models if hasattr(self, model.name)}
+
+    def _refresh_background(self, modified: dict):
+        try:
+            self._refresh(modified)
+        except Exception as e:
+            self.refresh_error = e
+
+    def wait(self):
+        # Wait for the background refresh, if any. Models stay read-only until it succeeded.
+        if self.parent is not None:
+            self.parent.wait()
+
+        if self.refresher is None:
+            return
+
+        if self.refresher.is_alive():
+            with yaspin(text="Refreshing data...", color="cyan"):
+                self.refresher.join()
+        self.refresher = None
+
+        if self.refresh_error is not None:
+            (e, self.refresh_error) = (self.refresh_error, None)
+            raise RuntimeError("Couldn't refresh from the API, working from the local snapshot (read-only)") from e
 
-        form_sheet       = self.sac.open_by_url(config.records["sheets"]["form"])
-        interviews_sheet = self.sac.open_by_url(config.records["sheets"]["interviews"])
-        old_automator_sheet = self.sac.open_by_url(config.records["sheets"]["old_automator"])
+    def api_stats(self) -> pl.DataFrame:
+        # Sheets API usage of every model since startup
+        owner = self.parent or self
+        stats = owner.sheets_api.stats() if owner.sheets_api is not None else {}
+        rows = []
 
-        self.form = FormModel(form_sheet)
-        self.scores = ScoresModel(interviews_sheet)
-        self.schedules = ScheduleModel(interviews_sheet)
-        self.old_automator = OldAutomatorModel(old_automator_sheet)
+        for name in self.model_names():
+            worksheet = getattr(self, name).worksheet
+            counters = stats.get(getattr(worksheet, "key", None), {})
+            rows.append({"model": name, **{c: counters.get(c, 0) for c in ("calls", "retries", "cells", "bytes")}})
 
-    
-    def backup_data(self):
-        # Write form data to files
-        self.form.records.write_excel("./.data/form.xlsx")
-        self.scores.records.write_excel("./.data/scores.xlsx")
-        self.schedules.records.write_excel("./.data/schedules.xlsx")
-        self.old_automator.records.write_excel("./.data/old_automator.xlsx")
+        return pl.DataFrame(rows)
 
     # -------------------------------------------------------------------------
     #                       SYNCHRONIZATION HEURISTICS
     # -------------------------------------------------------------------------
 
+    # Share one match graph between every heuristic run inside this block. The outermost caller
+    # builds it, and saves it once everything succeeded if it asked to. Several heuristics read the
+    # same edge, so only a run of all of them (`sync_all`) may mark its changes as seen.
+    @contextmanager
+    def matching(self, save: bool = False):
+        if self.graph is not None:
+            yield self.graph
+            return
+
+        self.graph = MatchGraph(self.state)
+        try:
+            yield self.graph
+            if save:
+                self.graph.save()
+        finally:
+            self.graph = None
+
+    def subsystem_rows(self) -> list:
+        # Form responses with this subsystem as their first or second preference. The form is
+        # partitioned once for every subsystem of the run, and again only when it's reloaded.
+        owner = self.parent or self
+        if owner._partition is None or owner._partition[0] is not self.form:
+            owner._partition = (self.form, partition(self.form))
+
+        return owner._partition[1].get(self.config.records["subsystem"].strip().lower(), [])
+
     # Duplicate checking and removal
     @staticmethod
-    def duplicate_score(A_name: str, A_reg: str, A_ph: PhoneNumber, B_name: str, B_reg: str, B_ph: PhoneNumber):
-        return (SequenceMatcher(None, A_name, B_name).ratio() * 2) + \
-               (SequenceMatcher(None, A_reg, B_reg).ratio() * 3) +   \
-               (A_ph == B_ph)
+    def duplicate_score(A_name: str, A_reg: str, A_ph: str, B_name: str, B_reg: str, B_ph: str):
+        return automate.matching.duplicate_score(A_name, A_reg, A_ph, B_name, B_reg, B_ph)
 
 
     def sync_duplicates_scores(self):
         """Synchronize duplicate score sheet entries."""
 
-        with self.scores.update() as update:
-            for (n, row) in enumerate(self.scores.records.iter_rows(named=True)):
-                for (m, check_row) in enumerate(self.scores.records.iter_rows(named=True)):
-                    if (m > n):
-                        x = Automator.duplicate_score(row["Full Name"],
-                                                row["Registration No."],
-                                                None,
-                                                check_row["Full Name"],
-                                                check_row["Registration No."],
-                                                None)
-                        
-                        if x > 0.90 * 6:
-                            score = float(row["Overall"].strip())
-                            check_score = float(check_row["Overall"])
-
-                            if check_score != 0:
-                                if score == check_score:
-                                    automate.log.info(f"Duplicate {check_row['Full Name']} is already synchronised")
-
-                                elif score == 0:
-                                    update.cell("Overall", n, check_score)
-                                    update.cell("Remarks", n, "duplicate")
-                                    automate.log.info(f"Found non-updated (pre) duplicate {check_row['Full Name']} with overall {check_score}.")
-
-                                else:
-                                    automate.log.info(f"Found conflicting duplicate {check_row['Full Name']} with overalls {check_score} and {row}.")
-
-                            else:
-                                if score != 0:
-                                    update.cell("Overall", m, score)
-                                    update.cell("Remarks", m, "duplicate")
-                                    automate.log.info(f"Found non-updated duplicate {check_row['Full Name']} with overall {score}.")
-                                
-                                if score == 0:
-                                    if row["Remarks"] != "duplicate":
-                                        update.cell("Remarks", n, "duplicate")
-                                        automate.log.info(f"Found non-done duplicate {check_row['Full Name']}")
-                                    else:
-                                        automate.log.info(f"Duplicate {check_row['Full Name']} is already synchronised")
-                                
+        with self.matching() as graph, self.scores.update(background=True) as update:
+            (rows, _) = graph.lookup(self.scores, threshold=0.90 * 6)
+            clusters = self.score_clusters(graph)
+
+            # Only clusters with a row that changed need another look
+            dirty = set(clusters.gather(rows).to_list()) if len(rows) > 0 else set()
+            members = pl.DataFrame([clusters]).with_row_index("row") \
+                        .filter(pl.col("cluster").is_in(list(dirty))) \
+                        .group_by("cluster").agg(pl.col("row").sort()) \
+                        .filter(pl.col("row").list.len() > 1) \
+                        .sort("cluster")
+
+            overall = self.scores.norm.get_column("Overall")
+            remarks = self.scores.norm.get_column("Remarks")
+
+            for cluster in members["row"].to_list():
+                name = self.scores.records[cluster[-1], "Full Name"]
+                scores = {overall[r] for r in cluster if overall[r] != 0}
+
+                if len(scores) > 1:
+                    automate.log.warn(f"Found conflicting duplicates of {name} with overalls {sorted(scores)}.", rows=len(cluster))
+                    continue
+
+                # Every write of a cluster goes out together
+                with update.group():
+                    if len(scores) == 1:
+                        # The scored rows are canonical, the others take their score
+                        score = scores.pop()
+                        stale = [r for r in cluster if overall[r] == 0]
+
+                        for r in stale:
+                            update.cell("Overall", r, score)
+                            update.cell("Remarks", r, "duplicate")
+
+                        if len(stale) > 0:
+                            automate.log.info(f"Found {len(stale)} non-updated duplicates of {name} with overall {score}.")
+                        else:
+                            automate.log.info(f"Duplicates of {name} are already synchronised")
+
+                    else:
+                        # Nobody scored yet, the latest row is canonical and the rest are marked
+                        stale = [r for r in cluster[:-1] if remarks[r] != "duplicate"]
+
+                        for r in stale:
+                            update.cell("Remarks", r, "duplicate")
+
+                        if len(stale) > 0:
+                            automate.log.info(f"Found {len(stale)} non-done duplicates of {name}")
+                        else:
+                            automate.log.info(f"Duplicates of {name} are already synchronised")
+
+            # Reuses this pass's graph rather than matching the sheet again
+            conflicts = self.score_conflicts()
+
+        if conflicts.height > 0:
+            os.makedirs(self.reports, exist_ok=True)
+            conflicts.write_csv(os.path.join(self.reports, "score_conflicts.csv"))
+
+    def score_clusters(self, graph: MatchGraph) -> pl.Series:
+        # Rows of the score sheet that are the same person, matched directly or through each other,
+        # labelled with the first row of their cluster
+        return automate.graph.clusters(graph.pairs(self.scores, threshold=0.90 * 6), self.scores.records.height)
+
+    def score_conflicts(self) -> pl.DataFrame:
+        # Every row of the duplicate clusters whose (non-zero) overalls disagree. Just a report, so
+        # the graph is never saved (`matching` without `save`), whether it's this one's or the pass's.
+        with self.matching() as graph:
+            clusters = self.score_clusters(graph)
+
+        rows = pl.concat([self.scores.records, self.scores.norm.select(pl.col("Overall").alias("score"))], how="horizontal") \
+                 .with_columns(clusters) \
+                 .with_row_index("row")
+
+        conflicting = rows.filter(pl.col("score") != 0) \
+                          .group_by("cluster").agg(pl.col("score").n_unique().alias("scores")) \
+                          .filter(pl.col("scores") > 1)["cluster"]
+
+        return rows.filter(pl.col("cluster").is_in(conflicting.implode())) \
+                   .select(pl.col("cluster") + 2, pl.col("row") + 2, "Full Name", "Registration No.", "Overall",
+                           *[col for col in ("Interviewers", "Remarks") if col in rows.columns]) \
+                   .sort("cluster", "row")
 
 
     def sync_notified(self):
         """Migrate notified members from old automator script."""
 
-        with self.schedules.update() as update:
-            for (n, row) in enumerate(self.old_automator.records.iter_rows(named=True)):
-                # Check if they came for the interview
-                for (m, sched_row) in enumerate(self.schedules.records.iter_rows(named=True)):
-                    x = Automator.duplicate_score(row["Full Name"],
-                                            row["Registration No. "],
-                                            row["WhatsApp Number"],
-                                            sched_row["Full Name"],
-                                            sched_row["Registration No."],
-                                            sched_row["WhatsApp Number"])
-                    if x > 0.90 * 6:
-                        sched_time = row[f"Notified_{config.records['subsystem']}"].strip()
+        with self.matching() as graph, self.schedules.update(background=True) as update:
+            (_, matches) = graph.lookup(self.old_automator, self.schedules, threshold=0.90 * 6)
+
+            for (n, m, x) in matches.iter_rows():
+                row = self.old_automator.records.row(n, named=True)
+                sched_row = self.schedules.records.row(m, named=True)
+                sched_norm = self.schedules.norm.row(m, named=True)
+
+                sched_time = row[f"Notified_{self.config.records['subsystem']}"].strip()
 
-                        if sched_row["Interview Date/Time"].strip() == "":
-                            print(f"{n} [{x}]:", end='\t')
-                            update.cell("Interview Date/Time", m, sched_time)
+                if sched_norm["Interview Date/Time"] == "":
+                    print(f"{n} [{x}]:", end='\t')
+                    update.cell("Interview Date/Time", m, sched_time)
 
-                            if (sched_row["WS Sender"].strip() == "" and sched_time != "") or row["MemberNotifier"] == "":
-                                update.cell("WS Sender", m, row["MemberNotifier"])
+                    if (sched_norm["WS Sender"] == "" and sched_time != "") or self.old_automator.norm[n, "MemberNotifier"] == "":
+                        update.cell("WS Sender", m, row["MemberNotifier"])
 
-                            automate.log.info(f"Updated {sched_row['Full Name']} with {sched_time}")
+                    automate.log.info(f"Updated {sched_row['Full Name']} with {sched_time}")
 
 
     def sync_no_shows(self):
         """Synchronize no-shows with score sheet."""
 
-        with self.scores.update() as update:
-            for (n, row) in enumerate(self.schedules.records.iter_rows(named=True)):
-                for (m, check_row) in enumerate(self.scores.records.iter_rows(named=True)):
-                    x = Automator.duplicate_score(row["Full Name"],
-                                            row["Registration No."],
-                                            None,
-                                            check_row["Full Name"],
-                                            check_row["Registration No."],
-                                            None)
-                    if x > 0.90 * 6:
-                        remarks = row["Remarks"].casefold().strip()
+        with self.matching() as graph, self.scores.update(background=True) as update:
+            (_, matches) = graph.lookup(self.schedules, self.scores, threshold=0.90 * 6)
 
-                        if remarks == "no show" or remarks == "no show, no reply":
-                            update.cell("Remarks", m, remarks)
-                            automate.log.info(f"Updated {row['Full Name']} with {remarks}")
+            for (n, m, x) in matches.iter_rows():
+                remarks = self.schedules.norm[n, "Remarks"]
+
+                if remarks == "no show" or remarks == "no show, no reply":
+                    update.cell("Remarks", m, remarks)
+                    automate.log.info(f"Updated {self.schedules.records[n, 'Full Name']} with {remarks}")
 
 
     # Check if they came for the interview
     def sync_appearances(self):
         """Synchronize show-ups with schedule sheet."""
-        
-        with self.schedules.update() as update:
-            for (n, row) in enumerate(self.scores.records.iter_rows(named=True)):
-                for (m, sched_row) in enumerate(self.schedules.records.iter_rows(named=True)):
-                    x = Automator.duplicate_score(row["Full Name"],
-                                            row["Registration No."],
-                                            None,
-                                            sched_row["Full Name"],
-                                            sched_row["Registration No."],
-                                            None)
-                    if x > 0.90 * 6:
-                        if (float(row["Overall"].strip()) > 0 or row["Interviewers"].strip() != "") and sched_row["Appeared"].casefold().strip() == "":
-                            print(f"{n} [{x}]:", end='\t')
-                            update.cell("Appeared", m, "yes")
-
-                            automate.log.info(f"Updated {sched_row['Full Name']} with `yes`")
 
+        with self.matching() as graph, self.schedules.update(background=True) as update:
+            (_, matches) = graph.lookup(self.scores, self.schedules, threshold=0.90 * 6)
 
-    def sync_registry(self):
-        """Synchronize form responses with schedule sheet."""
+            for (n, m, x) in matches.iter_rows():
+                row = self.scores.norm.row(n, named=True)
 
-        with self.schedules.update() as update_sched:
-            with self.scores.update() as update_score:
-                for (n, row) in enumerate(self.form.records.iter_rows(named=True)):
-                    if row["First Preference of Subsystem"].casefold().strip() == self.config.records["subsystem"].casefold().strip() or \
-                        row["Second Preference of Subsystem"].casefold().strip() == self.config.records["subsystem"].casefold().strip():
-
-                        # Update schedule sheet
-                        count_scheds = 0
-
-                        for (m, check_row) in enumerate(self.schedules.records.iter_rows(named=True)):
-                            x = Automator.duplicate_score(row["Full Name"],
-                                                row["Registration No. "],
-                                                row["WhatsApp Number"],
-                                                check_row["Full Name"],
-                                                check_row["Registration No."],
-                                                check_row["WhatsApp Number"])
-                            if x > 0.82 * 6:
-                                break
-                        else:
-                            k = m + count_scheds
-                            update_sched.cell("Full Name", k, row["Full Name"])
-                            update_sched.cell("Registration No.", k, row["Registration No. "])
-                            update_sched.cell("WhatsApp Number", k, row["WhatsApp Number"])
-                            update_sched.cell("Branch", k, row["Branch"])
-                            update_sched.cell("First Preference of Subsystem", k, row["First Preference of Subsystem"])
-
-                            automate.log.info(f"Adding {row['Full Name']} to the schedules list")
-                            count_scheds += 1
-
-                        # Update score sheet
-                        count_scores = 0
-
-                        for (m, check_row) in enumerate(self.scores.records.iter_rows(named=True)):
-                            x = Automator.duplicate_score(row["Full Name"],
-                                                row["Registration No. "],
-                                                None,
-                                                check_row["Full Name"],
-                                                check_row["Registration No."],
-                                                None)
-                            if x > 0.82 * 6:
-                                break
-                        else:
-                            k = m + count_scores
-                            update_sched.cell("Full Name", k, row["Full Name"])
-                            update_sched.cell("Registration No.", k, row["Registration No. "])
+                if (row["Overall"] > 0 or row["Interviewers"] != "") and self.schedules.norm[m, "Appeared"] == "":
+                    print(f"{n} [{x}]:", end='\t')
+                    update.cell("Appeared", m, "yes")
 
-                            automate.log.info(f"Adding {row['Full Name']} to the scores list")
-                            count_scores += 1
+                    automate.log.info(f"Updated {self.schedules.records[m, 'Full Name']} with `yes`")
 
 
-    def sync_all(self):
-        # Run all synchronization heuristics
+    def sync_registry(self):
+        """Synchronize form responses with schedule sheet."""
 
-        heuristics = [
+        rows = self.subsystem_rows()
+
+        # Form rows added during this run, whose new rows aren't in the match tables
+        written_scheds = set()
+        written_scores = set()
+
+        def partners(model, dirty, found):
+            # A row added here copies the identity columns of its form row, so it matches another
+            # form row exactly when its form row does. Those matches are found at once, among the
+            # form rows that may get added.
+            adding = sorted(dirty - found)
+            cols = ("name", "reg", "phone" if model.phone_col is not None else None)
+            pairs = automate.matching.match_table(self.form.keys, cols, self.form.keys, cols, threshold=0.82 * 6,
+                                                  left_rows=adding, right_rows=adding)
+
+            found = {}
+            for (a, b) in pairs.filter(pl.col("left") != pl.col("right")).select("left", "right").iter_rows():
+                found.setdefault(a, set()).add(b)
+            return found
+
+        def is_written(n, partners, written):
+            return len(partners.get(n, set()) & written) > 0
+
+        with self.matching() as graph, \
+             self.schedules.update(background=True) as update_sched, \
+             self.scores.update(background=True) as update_score:
+
+            (dirty_scheds, in_scheds) = graph.lookup(self.form, self.schedules, threshold=0.82 * 6, rows=rows)
+            (dirty_scores, in_scores) = graph.lookup(self.form, self.scores, threshold=0.82 * 6, rows=rows)
+
+            in_scheds = set(in_scheds["left"].to_list())
+            in_scores = set(in_scores["left"].to_list())
+            dirty_scheds = set(dirty_scheds)
+            dirty_scores = set(dirty_scores)
+
+            partners_scheds = partners(self.schedules, dirty_scheds, in_scheds)
+            partners_scores = partners(self.scores, dirty_scores, in_scores)
+
+            for n in sorted(dirty_scheds | dirty_scores):
+                row = self.form.records.row(n, named=True)
+
+                # Update schedule sheet
+                if n in dirty_scheds and n not in in_scheds and not is_written(n, partners_scheds, written_scheds):
+                    update_sched.append({
+                        "Full Name": row["Full Name"],
+                        "Registration No.": row["Registration No. "],
+                        "WhatsApp Number": row["WhatsApp Number"],
+                        "Branch": row["Branch"],
+                        "First Preference of Subsystem": row["First Preference of Subsystem"],
+                    })
+                    written_scheds.add(n)
+
+                    automate.log.info(f"Adding {row['Full Name']} to the schedules list")
+
+                # Update score sheet
+                if n in dirty_scores and n not in in_scores and not is_written(n, partners_scores, written_scores):
+                    update_score.append({
+                        "Full Name": row["Full Name"],
+                        "Registration No.": row["Registration No. "],
+                    })
+                    written_scores.add(n)
+
+                    automate.log.info(f"Adding {row['Full Name']} to the scores list")
+
+
+    def heuristics(self) -> list:
+        # Synchronization heuristics run by `sync_all`, in order
+        return [
             self.sync_registry,
             # self.sync_notified, -x- DISABLED
             self.sync_duplicates_scores,
@@ -248,88 +549,385 @@ class Automator:
             self.sync_no_shows
         ]
 
-        for h in heuristics:
-            with yaspin(text=h.__doc__, color="green"):
-                h()
+    def match_sheets(self, graph: MatchGraph):
+        # Every cross-sheet match the heuristics need, each computed once at the lowest threshold
+        # that uses it
+        rows = self.subsystem_rows()
+        graph.add(self.form, self.schedules, threshold=0.82 * 6, rows=rows)
+        graph.add(self.form, self.scores, threshold=0.82 * 6, rows=rows)
+        graph.add(self.scores, threshold=0.90 * 6)
+        graph.add(self.scores, self.schedules, threshold=0.90 * 6)
+
+    def sync_all(self, full: bool = False):
+        # Run all synchronization heuristics. Only rows changed since the last run are looked at,
+        # unless `full` is set.
+
+        self.state.enabled = not full
+
+        try:
+            with self.matching(save=True) as graph:
+                with spinner("Matching sheets...", color="green"), automate.metrics.span("match_sheets", full=full):
+                    self.match_sheets(graph)
+
+                for h in self.heuristics():
+                    with spinner(h.__doc__, color="green"), automate.metrics.span("heuristic", heuristic=h.__name__):
+                        h()
+        finally:
+            self.state.enabled = True
+            automate.metrics.export()
+
+    def subsystems(self) -> list:
+        # This subsystem and every one in `subsystems` (settings.yaml), each an `Automator` of its
+        # own interviews spreadsheet sharing this one's form
+        if self.children is None:
+            self.children = []
+            for entry in self.config.records.get("subsystems") or []:
+                config = copy.copy(self.config)
+                config.records = {
+                    **self.config.records,
+                    "subsystem": entry["subsystem"],
+                    "sheets": {**self.config.records["sheets"], "interviews": entry["interviews"]},
+                }
+                self.children.append(Automator(config, self.offline, self.client, parent=self))
+
+        return [self] + self.children
+
+    def sync_subsystems(self, full: bool = False):
+        # `sync_all` for every subsystem at once, in parallel. The form is loaded, normalized and
+        # partitioned by preference once for all of them, and they share one API quota.
+        automators = self.subsystems()
+        for auto in automators:
+            auto.wait()
+        self.subsystem_rows()
+
+        def sync(auto):
+            with automate.metrics.span("sync_subsystem", subsystem=auto.config.records["subsystem"]):
+                auto.sync_all(full)
+
+        with spinner(f"Syncing {len(automators)} subsystems...", color="green"), \
+                ThreadPoolExecutor(max_workers=len(automators)) as pool:
+            results = {auto.config.records["subsystem"]: pool.submit(sync, auto) for auto in automators}
+
+        failed = []
+        for (subsystem, result) in results.items():
+            if result.exception() is not None:
+                failed.append(subsystem)
+                automate.log.warn(f"Syncing {subsystem} failed: {result.exception()!r}", subsystem=subsystem)
+
+        if len(failed) > 0:
+            raise RuntimeError(f"Couldn't sync {', '.join(failed)}") from results[failed[0]].exception()
+
+
+    def watch(self, interval: float = None):
+        # Poll the sheets every `interval` seconds and sync whatever changed, until interrupted. Only
+        # spreadsheets modified since the last poll are fetched (the form just for its new rows), and
+        # the heuristics only look at rows changed since the last pass. Failed polls are retried
+        # with backoff, the loop itself never gives up.
+        interval = interval or float(self.config.records.get("watch", {}).get("interval", 60))
+        automate.log.info(f"Watching the sheets every {interval:.0f}s, Ctrl+C to stop.")
+
+        # Row hashes of every model at the end of the last pass, to tell how much the next one has
+        # to look at
+        synced = {}
+        last_pass = time.monotonic()
+        failures = 0
+
+        while True:
+            start = time.monotonic()
+
+            try:
+                with automate.metrics.span("watch_poll") as fields:
+                    changed = self._refresh(self.modified)
+
+                    # Rows added or edited since the last pass (all of them if rows went missing)
+                    backlog = 0
+                    for name in self.model_names():
+                        current = row_hashes(getattr(self, name))
+                        rows = changed_rows(current, synced[name]) if name in synced else None
+                        backlog += current.len() if rows is None else len(rows)
+
+                    automate.metrics.gauge("watch_backlog_rows", backlog)
+                    fields["backlog"] = backlog
+
+                    if backlog > 0:
+                        self.sync_all()
+                        synced = {name: row_hashes(getattr(self, name)) for name in self.model_names()}
+
+                    last_pass = time.monotonic()
+                    failures = 0
+
+                if backlog > 0:
+                    automate.log.info(f"Synced {backlog} changed rows", sheets=",".join(changed),
+                                      seconds=f"{time.monotonic() - start:.1f}")
+            except Exception as e:
+                failures += 1
+                automate.metrics.count("watch_errors")
+                automate.log.warn(f"Poll failed, trying again: {e!r}", failures=failures)
+
+            latency = time.monotonic() - start
+            automate.metrics.gauge("watch_loop_seconds", latency)
+            automate.metrics.gauge("watch_lag_seconds", time.monotonic() - last_pass)
+            automate.metrics.export()
+
+            # Dropped models and match graphs are reference cycles, don't let them pile up for days
+            gc.collect()
+
+            time.sleep(max(interval - latency, backoff(failures, interval, 3600) if failures > 0 else 0))
+
+    def model_names(self) -> list:
+        # Models loaded so far, shared ones included
+        sheets = {**(self.parent.sheets if self.parent is not None else {}), **self.sheets}
+        return [model.name for models in sheets.values() for model in models]
 
 
     # -------------------------------------------------------------------------
     #                       SCHEDULING TOOLS
     # -------------------------------------------------------------------------
 
-    def run_scheduling(self):
-        print("🤖 Welcome to the Interview Scheduling Prompt. Answer the questions below to begin your automatic scheduling process. 🤖")
+    def prompt_block(self) -> pl.DataFrame:
+        # Slow to import, and only needed here
+        import dateparser
+        import timelength
+
         date = dateparser.parse(input("Begin time for schedule block: "))
         block = timedelta(seconds=timelength.TimeLength(input("Block duration: "), strict=True).to_seconds())
         duration = timedelta(seconds=timelength.TimeLength(input("Interview duration: "), strict=True).to_seconds())
         at_once = int(input("Concurrent interviews: "))
 
-        message = ''
-        with open("message.txt", "r") as f:
-            message = f.read()
+        return automate.planning.capacity(date, block, duration, at_once)
+
+    def run_planning(self):
+        # Preview (and optionally export) the plan for a block, without sending anything
+        free = self.prompt_block()
+        plan = automate.planning.plan(automate.planning.eligible(self.schedules), free)
+
+        with pl.Config(tbl_rows=-1):
+            print(plan)
+
+        path = input("Export plan to (leave empty to skip): ").strip()
+        if path != "":
+            plan.write_csv(path)
+
+    def candidate_keys(self) -> pl.Series:
+        # How the send journal tells schedule rows apart: the registration no., or the name without one
+        reg = self.schedules.norm.get_column("Registration No.")
+        name = self.schedules.records.get_column("Full Name").str.strip_chars().str.to_lowercase()
+        return pl.select(pl.when(reg != "").then(reg).otherwise(pl.lit("name:") + name)).to_series()
 
-        count = 0
-        time_slots = math.ceil(block / duration)
-        slot = 0 # time slot index
-        intv = 0 # interview index within slot
+    def replay_journal(self):
+        # Re-apply the sheet writes of messages sent by a run that didn't get to confirm them
+        pending = self.journal.pending()
+        if len(pending) == 0:
+            return
 
-        whatsapp = WhatsappInstance(self.config)
+        keys = self.candidate_keys()
 
         with self.schedules.update() as update:
-            for (n, row) in enumerate(self.schedules.records.iter_rows(named=True)):
-                if row["Interview Date/Time"].strip() == "" and row["Appeared"].casefold().strip() != "yes":
-                    if intv >= at_once:
-                        intv = 0
-                        slot += 1
-                        date += duration
+            for entry in pending:
+                n = entry["row"]
+                if n >= keys.len() or keys[n] != entry["candidate"]:
+                    # Rows moved since, look the candidate up
+                    found = (keys == entry["candidate"]).arg_true()
+                    if found.len() == 0:
+                        automate.log.warn(f"Couldn't find {entry['candidate']} to record their message of {entry['at']}")
+                        continue
+                    n = found[0]
+
+                for (col, value) in entry["cells"].items():
+                    if self.schedules.records[n, col] != value:
+                        update.cell(col, n, value)
+
+        for entry in pending:
+            self.journal.record("confirmed", entry["candidate"], entry["block"])
+        self.journal.sync()
+
+        automate.log.info(f"Re-applied {len(pending)} unconfirmed schedule(s) from the send journal")
+
+    def send_plan(self, plan: pl.DataFrame, block: str, whatsapp: "WhatsappPool", update, message: str):
+        # Message every candidate of `plan` about their slot in `block`, keeping every sender busy.
+        # Confirmed slots are written as they come in. Returns the (confirmed, failed) parts of the
+        # plan.
+        tries = int(self.config.records["whatsapp"]["tries"])
+        base = float(self.config.records["whatsapp"].get("backoff", 5))
+        cap = float(self.config.records["whatsapp"].get("pace", {}).get("max", 60))
+
+        keys = self.candidate_keys().gather(plan["row"])
+
+        def record(event, i, **fields):
+            # Test sends go to our own number, they don't count
+            if not automate.whatsapp.TEST_GUARD:
+                self.journal.record(event, keys[i], block, row=plan[i, "row"], **fields)
+
+        def submit(i, attempt):
+            when = plan[i, "time"].strftime("%d/%m/%Y, %I:%M %p")
+            user_message = message.format(name=plan[i, "Full Name"], date=when, subsystem=self.config.records["subsystem"])
+            whatsapp.submit(plan[i, "WhatsApp Number"], user_message, key=(i, attempt))
+
+        confirmed = []
+        failed = []
+
+        # Candidates waiting for a retry count as in flight
+        upcoming = iter(range(plan.height))
+        in_flight = 0
+        retries = []  # heap of (due, plan index, attempt)
+
+        while True:
+            while len(retries) > 0 and retries[0][0] <= time.monotonic():
+                (_, i, attempt) = heapq.heappop(retries)
+                submit(i, attempt)
+
+            while in_flight < whatsapp.size:
+                i = next(upcoming, None)
+                if i is None:
+                    break
+
+                if self.journal.is_sent(keys[i], block):
+                    # Already messaged about this block by an earlier run, just make sure it's recorded
+                    for (col, value) in self.journal.sent[(keys[i], block)]["cells"].items():
+                        update.cell(col, plan[i, "row"], value)
+                    confirmed.append(i)
+                    continue
+
+                record("planned", i, time=plan[i, "time"].isoformat(), room=plan[i, "room"])
+                submit(i, 1)
+                in_flight += 1
+
+            if in_flight == 0:
+                break
 
-                    if slot >= time_slots:
-                        break
+            job = whatsapp.result(timeout=max(0.0, retries[0][0] - time.monotonic()) if len(retries) > 0 else None)
+            if job is None:
+                continue
 
-                    formatted_date = date.strftime("%d/%m/%Y, %I:%M %p")
-                    user_message = message.format(name=row["Full Name"], date=formatted_date, subsystem=self.config.records["subsystem"])
+            (i, attempt) = job.key
+            (n, name) = (plan[i, "row"], plan[i, "Full Name"])
 
-                    success = False
+            if job.error is not None and not job.timed_out and not job.ok:
+                print(f"[{n}] Oops! Failed to schedule {name}. Traceback follows.")
+                print("".join(traceback.format_exception(job.error)))
 
-                    for _ in range(int(self.config.records["whatsapp"]["tries"])):
-                        try:
-                            with whatsapp.direct(phonenumbers.parse(row["WhatsApp Number"], "IN")) as dm:
-                                process = multiprocessing.Process(target=dm.send, args=(user_message,))
-                                process.start()
-                                process.join(float(self.config.records["whatsapp"]["timeout"]))
+            if job.ok:
+                in_flight -= 1
+                confirmed.append(i)
 
-                                if process.is_alive():
-                                    process.terminate()
-                                    continue
+                if not automate.whatsapp.TEST_GUARD:
+                    # Journaled before it goes to the sheet, so a crash can't lose it
+                    cells = {
+                        "Interview Date/Time": f"Notified: {plan[i, 'time'].strftime('%d/%m/%Y, %I:%M %p')}",
+                        "WS Sender": job.sender,
+                    }
+                    record("sent", i, cells=cells, time=plan[i, "time"].isoformat(), room=plan[i, "room"])
 
-                            if not automate.whatsapp.TEST_GUARD:
-                                success = True
-                                update.cell("Interview Date/Time", n, f"Notified: {formatted_date}")
-                                update.cell("WS Sender", n, self.config.safety.name)
+                    for (col, value) in cells.items():
+                        update.cell(col, n, value)
 
-                            intv += 1
-                            count += 1
-                            time.sleep(float(self.config.records["whatsapp"]["sleep"]))
+                automate.log.info(f"[{job.sender}] Scheduled {name} at {plan[i, 'time'].strftime('%I:%M %p')} (room {plan[i, 'room']})")
 
-                        except Exception as _:
-                            print(f"[{n}] Oops! Failed to schedule {row['Full Name']}. Traceback follows.")
-                            print(traceback.format_exc())
+            elif attempt < tries:
+                heapq.heappush(retries, (time.monotonic() + backoff(attempt, base, cap), i, attempt + 1))
 
-                        else:
-                            break
+            else:
+                in_flight -= 1
+                failed.append(i)
+                record("failed", i)
+
+        return (plan[sorted(confirmed)], plan[sorted(failed)])
+
+    def run_scheduling(self):
+        from automate.whatsapp import WhatsappPool
+
+        print("🤖 Welcome to the Interview Scheduling Prompt. Answer the questions below to begin your automatic scheduling process. 🤖")
+        self.replay_journal()
+
+        # Browsers take a while to come up, with `whatsapp.prewarm` they're started while the
+        # questions are being answered
+        whatsapp = WhatsappPool(self.config) if self.config.records["whatsapp"].get("prewarm") else None
 
-                    if not success and not automate.whatsapp.TEST_GUARD:
+        try:
+            free = self.prompt_block()
+            block = free["time"].min().isoformat()
+
+            # Resuming a block: slots an earlier run already gave out stay taken
+            taken = [(entry["time"], entry["room"]) for ((_, b), entry) in self.journal.sent.items() if b == block]
+            if len(taken) > 0:
+                taken = pl.DataFrame(taken, schema={"time": pl.String, "room": pl.UInt32}, orient="row")
+                taken = free.join(taken.with_columns(pl.col("time").str.to_datetime(time_unit=free["time"].dtype.time_unit)),
+                                  on=["time", "room"])
+                free = automate.planning.leftover(free, taken)
+
+            message = ''
+            with open("message.txt", "r") as f:
+                message = f.read()
+
+            plan = automate.planning.plan(automate.planning.eligible(self.schedules), free)
+            planned = plan.filter(pl.col("slot").is_not_null())
+            waiting = plan.filter(pl.col("slot").is_null())
+
+            print(planned)
+            if input(f"Message these {planned.height} candidates? [y/n] ").casefold() != "y":
+                return
+
+            count = 0
+            failed = set()
+            replanned = set()
+
+            if whatsapp is None:
+                whatsapp = WhatsappPool(self.config)
+
+            with self.schedules.update(background=True) as update:
+                # Whatever capacity is left after a round (slots of candidates that couldn't be reached)
+                # is planned again: candidates that failed get one more go, ahead of those that didn't fit
+                # yet. Confirmed slots never move.
+                while planned.height > 0:
+                    (confirmed, missed) = self.send_plan(planned, block, whatsapp, update, message)
+
+                    count += confirmed.height
+                    failed = (failed | set(missed["row"].to_list())) - set(confirmed["row"].to_list())
+                    free = automate.planning.leftover(free, confirmed)
+
+                    retry = missed.filter(~pl.col("row").is_in(list(replanned)))
+                    replanned |= set(retry["row"].to_list())
+
+                    plan = automate.planning.plan(pl.concat([retry, waiting]), free)
+                    planned = plan.filter(pl.col("slot").is_not_null())
+                    waiting = plan.filter(pl.col("slot").is_null())
+
+                if not automate.whatsapp.TEST_GUARD:
+                    for n in sorted(failed):
                         update.cell("Interview Date/Time", n, "Message timed out")
                         update.cell("Appeared", n, "Resched")
-    
-        automate.log.info(f"Scheduled {count} interviews.")
+        finally:
+            if whatsapp is not None:
+                whatsapp.close()
+
+        # Every write went through
+        for entry in self.journal.pending():
+            self.journal.record("confirmed", entry["candidate"], entry["block"])
+        self.journal.sync()
+
+        automate.log.info(f"Scheduled {count} interviews, {len(failed)} couldn't be reached.", block=block, scheduled=count, failed=len(failed))
+        automate.metrics.export()
 
 
 if __name__ == '__main__':
     config = Config()
 
-    auto = Automator(config)
-    auto.backup_data()
+    # `--offline` works from the local snapshots only, nothing can be written back
+    auto = Automator(config, offline="--offline" in sys.argv[1:])
+
+    # Finish recording messages a crashed run sent
+    if not auto.offline and len(auto.journal.pending()) > 0:
+        auto.wait()
+        auto.replay_journal()
+
+    # `--watch` syncs unattended instead of prompting
+    if "--watch" in sys.argv[1:]:
+        auto.wait()
+        try:
+            auto.watch()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
 
     print(auto.scores.records)
 
@@ -337,6 +935,9 @@ if __name__ == '__main__':
         try:
             function = input(" >> ").lower().strip()
 
+            if function not in ("help", "exit"):
+                auto.wait()
+
             if function == "help":
                 print_help()
             elif function == "sync_notified":
@@ -351,7 +952,17 @@ if __name__ == '__main__':
                 auto.sync_registry()
             elif function == "sync_all":
                 auto.sync_all()
+            elif function == "sync_all_full":
+                auto.sync_all(full=True)
+            elif function == "sync_subsystems":
+                auto.sync_subsystems()
             
+            elif function == "score_conflicts":
+                print(auto.score_conflicts())
+            elif function == "api_stats":
+                print(auto.api_stats())
+            elif function == "plan":
+                auto.run_planning()
             elif function == "schedule":
                 auto.run_scheduling()
 